@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the pytest-it reporter hot paths.
+
+Generates synthetic test suites and measures the wall time and peak memory of:
+
+- a test run with pytest-it disabled, installed but not enabled, and with --it
+- --collect-only with and without --it
+- pytest_collection_modifyitems on its own, and with an --it-select pattern that
+  selects a fifth of the tests
+
+Usage::
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --output new.json --compare results.json
+
+Each pytest run happens in a fresh subprocess, so the peak RSS of one run doesn't
+leak into the next.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pytest
+
+import pytest_it
+from pytest_it import plugin
+
+TESTS_PER_MODULE = 200
+
+MODES = {
+    # Without the plugin the markers aren't registered, so don't time the warnings.
+    "run-no-plugin": [
+        "-p",
+        "no:cacheprovider",
+        "-p",
+        "no:it",
+        "-W",
+        "ignore::pytest.PytestUnknownMarkWarning",
+    ],
+    "run": ["-p", "no:cacheprovider"],
+    "run-it": ["-p", "no:cacheprovider", "--it", "--it-no-color"],
+    "collect": ["-p", "no:cacheprovider", "--collect-only", "-q"],
+    "collect-it": ["-p", "no:cacheprovider", "--collect-only", "--it", "--it-no-color"],
+}
+
+
+def generate_suite(path, tests, depth, fanout, doctests):
+    """
+    Write a suite of `tests` tests to `path`. Each test has `depth` Describe/Context
+    markers, split between the class and the function, is parametrised `fanout`
+    ways, and a `doctests` fraction of the test functions also have a doctest.
+    """
+    functions = max(1, tests // fanout)
+    per_module = max(1, TESTS_PER_MODULE // fanout)
+    doctest_every = int(round(1 / doctests)) if doctests else 0
+    for module in range(0, functions, per_module):
+        lines = ["import pytest", ""]
+        class_marks = [
+            '@pytest.mark.{}("{} {}")'.format(
+                "describe" if level % 2 == 0 else "context", "block", level
+            )
+            for level in range(depth // 2)
+        ]
+        lines.extend(class_marks)
+        lines.append("class TestBlock{}(object):".format(module))
+        for i in range(module, min(module + per_module, functions)):
+            func_marks = [
+                '    @pytest.mark.{}("{} {} {}")'.format(
+                    "describe" if level % 2 == 0 else "context", "block", level, i % 5
+                )
+                for level in range(depth // 2, depth)
+            ]
+            lines.extend(func_marks)
+            if fanout > 1:
+                lines.append(
+                    "    @pytest.mark.parametrize('param', range({}))".format(fanout)
+                )
+                signature = "self, param"
+            else:
+                signature = "self"
+            lines.append("    def test_it_does_thing_{}({}):".format(i, signature))
+            if doctest_every and i % doctest_every == 0:
+                lines.append('        """')
+                lines.append("        >>> 1 + 1")
+                lines.append("        2")
+                lines.append('        """')
+            lines.append("        assert True")
+            lines.append("")
+        with open(os.path.join(path, "test_bench_{}.py".format(module)), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def run_pytest(path, args):
+    """
+    Run pytest in a subprocess and return its wall time and peak RSS.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "_run", path] + args
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def _run(path, args):
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.perf_counter()
+        try:
+            pytest.main([path] + args)
+        finally:
+            wall = time.perf_counter() - start
+            sys.stdout = stdout
+    print(json.dumps({"wall": wall, "peak_rss_kb": _peak_rss_kb()}))
+
+
+def _peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class _CollectedItems(object):
+    def __init__(self):
+        self.config = None
+        self.items = []
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, config, items):
+        self.config = config
+        self.items = list(items)
+
+
+def select_pattern(depth):
+    """
+    An --it-select path for a suite generated with `depth`, matching the tests whose
+    function-level blocks are all "... 0".
+    """
+    return "/".join(
+        "block {}".format(level) if level < depth // 2 else "block {} 0".format(level)
+        for level in range(depth)
+    )
+
+
+def bench_modifyitems(path, doctests, select=""):
+    """
+    Time pytest-it's pytest_collection_modifyitems on its own, in a subprocess.
+    """
+    args = [sys.executable, os.path.abspath(__file__), "_modifyitems", path, select]
+    if doctests:
+        args.append("--doctest-modules")
+    output = subprocess.check_output(args)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def _modifyitems(path, select, args):
+    """
+    Collect the suite without pytest-it, then call its hook against the items.
+    """
+    collected = _CollectedItems()
+    args = [
+        path,
+        "--collect-only",
+        "-q",
+        "-p",
+        "no:cacheprovider",
+        "-p",
+        "no:it",
+    ] + args
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            pytest.main(args, plugins=[collected])
+        finally:
+            sys.stdout = stdout
+    items = collected.items
+    collected.config.option.it_select = (
+        [plugin._select_pattern(select)] if select else []
+    )
+    collected.config.option.it_dist_group = None
+    collected.config.option.it_shard = None
+    tracemalloc.start()
+    start = time.perf_counter()
+    hook = plugin.ItPlugin().pytest_collection_modifyitems(collected.config, items)
+    next(hook)
+    try:
+        next(hook)
+    except StopIteration:
+        pass
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({"wall": wall, "peak_alloc_kb": peak // 1024}))
+
+
+def run_benchmarks(suites, modes, repeat):
+    results = []
+    for suite in suites:
+        path = tempfile.mkdtemp(prefix="pytest-it-bench-")
+        try:
+            generate_suite(path, **suite)
+            for mode in modes:
+                args = list(MODES[mode])
+                if suite["doctests"]:
+                    args.append("--doctest-modules")
+                runs = [run_pytest(path, args) for _ in range(repeat)]
+                result = {
+                    "wall": min(r["wall"] for r in runs),
+                    "peak_rss_kb": min(r["peak_rss_kb"] for r in runs),
+                }
+                results.append(_row(suite, mode, result))
+                _print_row(results[-1])
+            result = bench_modifyitems(path, suite["doctests"])
+            results.append(_row(suite, "modifyitems", result))
+            _print_row(results[-1])
+            select = select_pattern(suite["depth"])
+            result = bench_modifyitems(path, suite["doctests"], select)
+            results.append(_row(suite, "it-select", result))
+            _print_row(results[-1])
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def _row(suite, mode, result):
+    row = dict(suite)
+    row["mode"] = mode
+    row.update(result)
+    return row
+
+
+def _key(row):
+    return (row["tests"], row["depth"], row["fanout"], row["doctests"], row["mode"])
+
+
+def _print_row(row, baseline=None):
+    line = "{mode:<12} tests={tests:<7} depth={depth:<2} fanout={fanout:<3} doctests={doctests:<4} {wall:8.3f}s".format(
+        **row
+    )
+    if "peak_rss_kb" in row:
+        line += " {:8d}KB rss".format(row["peak_rss_kb"])
+    else:
+        line += " {:8d}KB alloc".format(row["peak_alloc_kb"])
+    if baseline is not None:
+        line += "  ({:+.1%} wall vs baseline)".format(
+            row["wall"] / baseline["wall"] - 1
+        )
+    print(line)
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Print each result against the matching result in the baseline file, and return
+    the results that are more than `threshold` times slower.
+    """
+    with open(baseline_path) as f:
+        baseline = {_key(row): row for row in json.load(f)["results"]}
+    regressions = []
+    print("\nCompared to {}:".format(baseline_path))
+    for row in results:
+        old = baseline.get(_key(row))
+        _print_row(row, old)
+        if old is not None and row["wall"] > old["wall"] * threshold:
+            regressions.append(row)
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--tests", type=int, nargs="+", default=[1000, 10000], help="Suite sizes"
+    )
+    parser.add_argument(
+        "--depth", type=int, nargs="+", default=[2, 6], help="Marker depths"
+    )
+    parser.add_argument(
+        "--fanout", type=int, nargs="+", default=[1, 10], help="Parametrisations"
+    )
+    parser.add_argument(
+        "--doctests",
+        type=float,
+        nargs="+",
+        default=[0.0],
+        help="Fraction of test functions with a doctest",
+    )
+    parser.add_argument(
+        "--mode", nargs="+", default=sorted(MODES), choices=sorted(MODES)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="A previous JSON results file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="With --compare, exit with an error if a result is this many times slower",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    if argv and argv[0] == "_run":
+        return _run(argv[1], argv[2:])
+    if argv and argv[0] == "_modifyitems":
+        return _modifyitems(argv[1], argv[2], argv[3:])
+    args = parse_args(argv)
+    suites = [
+        {"tests": tests, "depth": depth, "fanout": fanout, "doctests": doctests}
+        for tests in args.tests
+        for depth in args.depth
+        for fanout in args.fanout
+        for doctests in args.doctests
+    ]
+    results = run_benchmarks(suites, args.mode, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "python": platform.python_version(),
+                        "pytest": pytest.__version__,
+                        "pytest_it": pytest_it.__version__,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print("\n{} result(s) regressed".format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
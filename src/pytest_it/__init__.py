@@ -10,3 +10,5 @@ __email__ = "matt@mattduck.com"
 
 __license__ = "MIT"
 __copyright__ = "Copyright (c) 2019 Matthew Duck"
+
+from pytest_it.plugin import ItSpec, SpecIndex, get_spec_index  # noqa: E402,F401
@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from collections import defaultdict
+import argparse
+import array
+import fnmatch
+import functools
+import hashlib
+import html
+import json
+import os
+import queue
+import re
+import threading
+import time
 
 import pytest
 from _pytest.pathlib import bestrelpath
@@ -9,6 +20,10 @@ from _pytest.terminal import TerminalReporter
 
 REGISTERED = False
 
+SPEC_KEY = pytest.StashKey()
+SPEC_INDEX_KEY = pytest.StashKey()
+FRAME_TABLE_KEY = pytest.StashKey()
+
 
 def pytest_addoption(parser):
     group = parser.getgroup("terminal reporting", "reporting", after="general")
@@ -26,17 +41,287 @@ def pytest_addoption(parser):
         default=None,
         help="Disable coloured output when using --it",
     )
+    group.addoption(
+        "--it-flush-interval",
+        action="store",
+        dest="it_flush_interval",
+        type=float,
+        default=0.5,
+        metavar="SECONDS",
+        help="Buffer the --it output and write it to the terminal within SECONDS, "
+        "or at the end of each module. Use 0 to write every line immediately "
+        "(default: 0.5)",
+    )
+    group.addoption(
+        "--it-output-thread",
+        action="store_true",
+        dest="it_output_thread",
+        default=False,
+        help="With --it, write the output to the terminal from a background thread, "
+        "so that the tests don't wait for a slow terminal or pipe",
+    )
+    group.addoption(
+        "--it-jsonl",
+        action="store",
+        dest="it_jsonl",
+        default=None,
+        metavar="PATH",
+        help="Write a JSON Lines record of the Describe/Context/It path and result of "
+        "each test to PATH. Can be used with or without --it",
+    )
+    group.addoption(
+        "--it-export",
+        action="append",
+        dest="it_export",
+        type=_export_target,
+        default=[],
+        metavar="FORMAT:PATH",
+        help="Write the spec and the result of each test to PATH as it runs, where "
+        "FORMAT is one of org, markdown or html. Can be given more than once, and "
+        "can be used with or without --it",
+    )
+    group.addoption(
+        "--it-select",
+        action="append",
+        dest="it_select",
+        type=_select_pattern,
+        default=[],
+        metavar="PATH",
+        help="Only run the tests in the Describe/Context blocks that match PATH, eg. "
+        "'Describe: The billing engine / Context: When the card is declined'. Each "
+        "/-separated part matches one block, case-insensitively, and can use shell "
+        "wildcards. The last part can be 'It: ...' to match the tests in the block. "
+        "Can be given more than once to run the tests that match any of them",
+    )
+    group.addoption(
+        "--it-dist-group",
+        action="store",
+        dest="it_dist_group",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Add an xdist_group marker to each test, named after its outermost N "
+        "Describe/Context blocks, so that with pytest-xdist's --dist loadgroup each "
+        "block runs on one worker and shares its fixtures",
+    )
+    group.addoption(
+        "--it-shard",
+        action="store",
+        dest="it_shard",
+        type=_shard,
+        default=None,
+        metavar="K/N",
+        help="Split the tests into N shards of roughly equal duration and only run "
+        "shard K (counting from 1). Each top-level Describe block stays on one "
+        "shard. The durations are predicted from previous pytest-it runs, or from "
+        "the number of tests if there's no history",
+    )
+    group.addoption(
+        "--it-snapshot",
+        action="store",
+        dest="it_snapshot",
+        default=None,
+        metavar="PATH",
+        help="Save a snapshot of the spec and the outcome of each test to PATH, for "
+        "use with --it-diff. The last run's snapshot is also kept in the pytest cache",
+    )
+    group.addoption(
+        "--it-diff",
+        action="store",
+        dest="it_diff",
+        default=None,
+        metavar="SNAPSHOT",
+        help="At the end of the run, show the spec lines that were added, removed or "
+        "changed outcome since SNAPSHOT, which is a file saved with --it-snapshot, or "
+        "'last' for the previous run that used pytest-it",
+    )
+    group.addoption(
+        "--it-only",
+        action="store",
+        dest="it_only",
+        type=_outcomes,
+        default=None,
+        metavar="OUTCOMES",
+        help="With --it, only display the tests with these comma-separated outcomes "
+        "(passed, failed, skipped) and the blocks that contain them, eg. "
+        "--it-only=failed,skipped. Each block displays a count of its hidden passing "
+        "tests when it closes",
+    )
+    group.addoption(
+        "--it-progress",
+        action="store_true",
+        dest="it_progress",
+        default=False,
+        help="With --it on a terminal, show a status line with the number of tests "
+        "completed, the tests per second, the current Describe block and the "
+        "estimated time remaining",
+    )
+    group.addoption(
+        "--it-grouped",
+        action="store_true",
+        dest="it_grouped",
+        default=False,
+        help="With --it, hold the results back and display each Describe/Context "
+        "block once at the end of the session, regardless of the order the tests ran",
+    )
+    group.addoption(
+        "--it-durations",
+        action="store",
+        dest="it_durations",
+        type=int,
+        default=None,
+        metavar="N",
+        help="With --it, show the total duration of each Describe/Context block when "
+        "it closes, and list the N slowest blocks (N=0 for all)",
+    )
+    group.addoption(
+        "--it-profile",
+        action="store_true",
+        dest="it_profile",
+        default=False,
+        help="Measure the time spent in pytest-it's own code during the run, and show "
+        "a breakdown by phase at the end",
+    )
+    group.addoption(
+        "--it-profile-json",
+        action="store",
+        dest="it_profile_json",
+        default=None,
+        metavar="PATH",
+        help="Like --it-profile, and also write the breakdown to PATH as JSON",
+    )
+    group.addoption(
+        "--it-coverage-contexts",
+        action="store_true",
+        dest="it_coverage_contexts",
+        default=False,
+        help="When coverage.py is measuring the run, switch its dynamic context at "
+        "each Describe/Context block, and show the number of lines each block covers",
+    )
+    group.addoption(
+        "--it-collect-cached",
+        action="store_true",
+        dest="it_collect_cached",
+        default=False,
+        help="With --collect-only and --it, cache the spec of each test module and "
+        "only re-collect the modules that have changed since the last run",
+    )
+
+
+def is_active(config):
+    """
+    Whether any pytest-it output has been requested for this run.
+    """
+    option = config.option
+    return any(
+        (
+            option.it,
+            option.it_color is False,
+            option.it_jsonl,
+            option.it_export,
+            option.it_select,
+            option.it_dist_group,
+            option.it_shard,
+            option.it_snapshot,
+            option.it_diff,
+            option.it_coverage_contexts,
+        )
+    )
+
+
+def _outcomes(value):
+    outcomes = set(o.strip() for o in value.split(",") if o.strip())
+    invalid = outcomes - {"passed", "failed", "skipped"}
+    if invalid or not outcomes:
+        raise argparse.ArgumentTypeError(
+            "expected a comma-separated list of passed, failed, skipped: {!r}".format(
+                value
+            )
+        )
+    return outcomes
+
+
+def _export_target(value):
+    fmt, sep, path = value.partition(":")
+    if not sep or not path or fmt not in EXPORT_FORMATS:
+        raise argparse.ArgumentTypeError(
+            "expected FORMAT:PATH where FORMAT is one of {}: {!r}".format(
+                ", ".join(sorted(EXPORT_FORMATS)), value
+            )
+        )
+    return fmt, path
+
+
+def _select_pattern(value):
+    """
+    Parse an --it-select path into a tuple of ``(kind, regex)`` parts, where kind is
+    None if the part can match any kind of block.
+    """
+    parts = []
+    for part in value.split("/"):
+        kind, sep, text = part.partition(":")
+        kind = kind.strip().lower()
+        if not sep or kind not in ("describe", "context", "it"):
+            kind, text = None, part
+        text = text.strip().lower()
+        if not text:
+            raise argparse.ArgumentTypeError("empty part in path: {!r}".format(value))
+        parts.append((kind, re.compile(fnmatch.translate(text))))
+    if any(kind == "it" for kind, _ in parts[:-1]):
+        raise argparse.ArgumentTypeError(
+            "'It:' can only be the last part of the path: {!r}".format(value)
+        )
+    return tuple(parts)
+
+
+def _shard(value):
+    try:
+        k, n = (int(part) for part in value.split("/"))
+    except ValueError:
+        k = n = 0
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(
+            "expected K/N where 1 <= K <= N: {!r}".format(value)
+        )
+    return k, n
 
 
 @pytest.hookimpl(trylast=True)
 def pytest_configure(config):
     global REGISTERED
-    if (config.option.it or (config.option.it_color is False)) and not REGISTERED:
+    enabled = config.option.it or (config.option.it_color is False)
+    is_worker = hasattr(config, "workerinput")  # pytest-xdist worker process
+    if is_active(config):
+        config.pluginmanager.register(ItPlugin(), "it-plugin")
+    if enabled and not REGISTERED and not is_worker:
         default = config.pluginmanager.getplugin("terminalreporter")
         config.pluginmanager.unregister(default)
         config.pluginmanager.register(
             ItTerminalReporter(default.config), "terminalreporter"
         )
+        if ItCollectCache.is_enabled(config):
+            config.pluginmanager.register(ItCollectCache(config), "it-collect-cache")
+    # A sharded run doesn't record its durations, otherwise the next shard to run on
+    # the same cache would predict a different split and run some tests twice.
+    record_durations = not is_worker and not config.option.it_shard
+    if is_active(config) and record_durations and getattr(config, "cache", None):
+        config.pluginmanager.register(
+            ItDurationHistory(config.cache), "it-duration-history"
+        )
+    if is_active(config) and not is_worker:
+        config.pluginmanager.register(ItSnapshot(config), "it-snapshot")
+    if config.option.it_coverage_contexts:
+        config.pluginmanager.register(ItCoverageContexts(), "it-coverage-contexts")
+    if config.option.it_jsonl and not is_worker:
+        config.pluginmanager.register(ItJsonlWriter(config.option.it_jsonl), "it-jsonl")
+    if config.option.it_export and not is_worker:
+        writers = [EXPORT_FORMATS[fmt](path) for fmt, path in config.option.it_export]
+        config.pluginmanager.register(ItExporter(writers), "it-export")
+    profile = config.option.it_profile or config.option.it_profile_json
+    if profile and not is_worker:
+        profile = ItProfile(config.option.it_profile_json)
+        profile.instrument(config)
+        config.pluginmanager.register(profile, "it-profile")
 
     config.addinivalue_line(
         "markers",
@@ -48,227 +333,2267 @@ def pytest_configure(config):
     )
     config.addinivalue_line(
         "markers",
-        """it(arg): pytest-it marker to specify the 'It: ' output for the report. If not provided, pytest-it will automatically add an 'It :' marker to any test function starting with `test_it_`.""",  # noqa
+        """it(arg): pytest-it marker to specify the 'It: ' output for the report. If not provided, pytest-it will automatically derive the 'It: ' output for any test function starting with `test_it_`.""",  # noqa
     )
 
 
-class ItItem(object):
+class ItSpec(object):
+    """
+    The Describe/Context/It path of a single test, resolved from its markers once at
+    collection time.
 
-    INDENT = "  "
-    COLORS = {
-        "reset": "\033[0m",
-        "passed": "\033[92m",
-        "failed": "\033[91m",
-        "skipped": "\033[93m",
-    }
+    ``frames`` is a tuple of ``(kind, text)`` pairs ordered from the outermost block
+    inwards, ``title`` is the closest ``it`` marker value (or None), ``module`` is the
+    nodeid of the test's module and ``param`` is the parametrisation id (or None).
 
-    def __init__(self, item):
-        assert item
-        self._item = item
+    If there's no ``it`` marker, ``function`` is the name of a test function that
+    follows the `test_it_does_something` convention, and the title is derived from it
+    when it's first needed.
 
-    @property
-    def path(self):
-        """Path to the test"""
+    ``frame_id`` is the id of the frames in the session's FrameTable, whose frames
+    tuple is shared by every spec in the same block. It's None if the frames weren't
+    interned.
 
-        # TODO: docstrings show up in the path. This is used for verbose mode. Should only show
-        # the actual path without docstrings.
-        return "::".join(self._item.nodeid.split("::")[:-1])
+    This is attached to each report in place of the pytest Item, so it must not hold
+    a reference to the Item itself.
+    """
 
-    def formatted_result(self, outcome):
-        icons = {"passed": "- ✓", "failed": "- F", "skipped": "- s"}
-        title = ""
-        for mark in self._item.iter_markers(name="it"):
-            try:
-                title = mark.args[0]
-                break
-            except IndexError:
-                pass
-        if title:
-            prefix = "It:"
-        else:
-            prefix = ""
-            title = self._item.name
-        try:
-            if "[doctest]" in self._item.location[-1]:
-                title = self._item.name + " - [doctest]"
-        except IndexError:
-            pass
-        if self._item.config.option.verbose > 0:
-            title = self.path + "::{} - {}".format(self._item.name, title)
-        if "[" in self._item.name:  # Parametrised test
-            title = title + " - [{}".format(self._item.name.split("[")[1])
-        return "{color}{icon}{prefix}{reset} {title}".format(
-            color=self.color(outcome),
-            reset=self.color("reset"),
-            icon=icons.get(outcome, "-"),
-            prefix=" " + prefix if prefix else "",
-            title=title,
-        )
+    __slots__ = ("frames", "_title", "module", "param", "function", "frame_id")
+
+    def __init__(self, frames, title, module, param=None, function=None, frame_id=None):
+        self.frames = frames
+        self._title = title
+        self.module = module
+        self.param = param
+        self.function = function
+        self.frame_id = frame_id
 
     @property
-    def parent_marks(self):
-        markers = []
-        for m in self._item.iter_markers():
+    def title(self):
+        if self._title is None and self.function is not None:
+            return auto_title(self.function)
+        return self._title
+
+    def __repr__(self):
+        return "ItSpec(frames={!r}, title={!r}, module={!r}, param={!r})".format(
+            self.frames, self.title, self.module, self.param
+        )
+
+    @classmethod
+    def from_item(cls, item):
+        frames = []
+        title = None
+        for m in item.iter_markers():
             if m.name in ("describe", "context"):
                 try:
-                    markers.append((m.name, m.args[0]))
+                    frames.append((m.name, m.args[0]))
+                except IndexError:
+                    pass
+            elif m.name == "it" and title is None:
+                try:
+                    title = m.args[0]
                 except IndexError:
                     pass
-        return list(reversed(markers))
+        function = None
+        if title is None:
+            function = getattr(item, "originalname", item.name)
+            if not function.startswith("test_it_"):
+                function = None
+        callspec = getattr(item, "callspec", None)
+        frames.reverse()
+        frame_id, frames = get_frame_table(item.config).intern(frames)
+        return cls(
+            frames=frames,
+            title=title,
+            module=item.nodeid.split("::")[0],
+            param=callspec.id if callspec is not None else None,
+            function=function,
+            frame_id=frame_id,
+        )
 
-    def color(self, s):
-        if self._item.config.option.it_color in (True, None):
-            return self.COLORS.get(s, self.COLORS["skipped"])
-        return ""
+    @classmethod
+    def from_nodeid(cls, nodeid):
+        """
+        Fallback for a report that wasn't produced by pytest_runtest_makereport, eg.
+        one created by another plugin.
+        """
+        return cls(frames=(), title=None, module=nodeid.split("::")[0])
 
-    def _print_marker(self, value, value_type, value_depth, type_depth, tw):
-        if value_type == "describe":
-            value = "- Describe: {}...".format(value.capitalize())
-        elif value_type == "context":
-            if type_depth > 1:
-                value = "- ...{}...".format(self._uncapitalize(value))
-            else:
-                value = "- Context: {}...".format(value.capitalize())
+    def to_json(self):
+        return {
+            "frames": [list(f) for f in self.frames],
+            "title": self.title,
+            "module": self.module,
+            "param": self.param,
+        }
 
-        if value_depth <= 3:
-            tw.sep(" ")
-        if value_depth <= 1:
-            tw.line(value)
+    @classmethod
+    def from_json(cls, data, table=None):
+        if table is None:
+            frame_id, frames = None, tuple(tuple(f) for f in data["frames"])
         else:
-            tw.line((self.INDENT * (value_depth - 1)) + value)
+            frame_id, frames = table.intern(tuple(f) for f in data["frames"])
+        return cls(
+            frames=frames,
+            title=data["title"],
+            module=data["module"],
+            param=data["param"],
+            frame_id=frame_id,
+        )
 
-    @property
-    def module(self):
+
+class FrameTable(object):
+    """
+    The session's table of interned Describe/Context frames. Many tests share the
+    same marker texts, so each distinct frames tuple is only stored once, along
+    with one copy of each string, and is referred to by a small integer id.
+
+    ``frames[id]`` is the frames tuple for an id, and ``parents[id]`` is the id of
+    its enclosing block (-1 for the root, which has id 0).
+    """
+
+    def __init__(self):
+        self._strings = {}
+        self._ids = {(): 0}
+        self.frames = [()]
+        self.parents = array.array("i", [-1])
+
+    def intern(self, frames):
+        """
+        Return the id and the shared tuple of a sequence of ``(kind, text)`` frames.
+        """
+        frames = tuple(frames)
         try:
-            return self._item.module
-        except AttributeError:
-            # a DocTestItem doesn't have a module attribute, but the parent
-            # does
-            return self._item.parent.module
-
-    def reconcile_and_print(self, prev, tw, outcome, is_first_test=False):
-        if prev:
-            prev_marks = prev.parent_marks
-            is_first_module_test = self.module != prev.module
-        else:
-            prev_marks, is_first_module_test = [], True
-        depth = defaultdict(int)
-        diff_broken = False
-        self_depth = 0
-        for self_depth, self_marker_info in enumerate(self.parent_marks, 1):
-            self_type, self_value = self_marker_info
-            depth[self_type] += 1
-
-            prev_marker_info = None
-            try:
-                prev_marker_info = prev_marks[self_depth - 1]
-            except IndexError:
-                diff_broken = True
-            if prev_marker_info != self_marker_info:
-                diff_broken = True
+            frame_id = self._ids[frames]
+        except KeyError:
+            frame_id = self._add(frames)
+        return frame_id, self.frames[frame_id]
 
-            if not diff_broken:
-                continue
+    def _add(self, frames):
+        try:
+            parent_id = self._ids[frames[:-1]]
+        except KeyError:
+            parent_id = self._add(frames[:-1])
+        strings = self._strings
+        kind, text = frames[-1]
+        frame = (strings.setdefault(kind, kind), strings.setdefault(text, text))
+        # Share the parent's frames, so only the innermost frame is new.
+        key = self.frames[parent_id] + (frame,)
+        frame_id = self._ids[key] = len(self.frames)
+        self.frames.append(key)
+        self.parents.append(parent_id)
+        return frame_id
 
-            # Start printing Describe/Context markers at the point where the
-            # marker hierarchy differs from the previous test.
-            self._print_marker(
-                value=self_value,
-                value_type=self_type,
-                value_depth=self_depth,
-                type_depth=depth[self_type],
-                tw=tw,
-            )
+    def id(self, frames):
+        """
+        The id of some frames that have been interned. Raises KeyError otherwise.
+        """
+        return self._ids[tuple(frames)]
 
-        # Print a separator before the test if this test is displayed after a deeper block.
-        prev_depth = max(0, (len(prev_marks)))
-        if self_depth < prev_depth and not diff_broken:
-            tw.sep(" ")
-        # If this is a new module, add a separate to avoid printing "* my_module.py... It: does something"
-        # on a single line.
-        elif self_depth == 0 and is_first_module_test:
-            tw.sep(" ")
 
-        # Print the test with appropriate indent
-        if self_depth:
-            tw.line((self.INDENT * self_depth) + self.formatted_result(outcome))
-        else:
-            tw.line(self.formatted_result(outcome))
+def get_frame_table(config):
+    try:
+        return config.stash[FRAME_TABLE_KEY]
+    except KeyError:
+        table = config.stash[FRAME_TABLE_KEY] = FrameTable()
+        return table
+
 
-    def _uncapitalize(self, s):
-        return s[0].lower() + s[1:]
+_AUTO_TITLES = {}
 
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_runtest_makereport(item, call):
-    result = yield
-    report = result.get_result()
-    report._item = item
+def auto_title(function):
+    """
+    Prettify a `test_it_does_something` function name into an 'It: ' title. This is
+    memoized, so the variants of a parametrised test share one result.
+    """
+    try:
+        return _AUTO_TITLES[function]
+    except KeyError:
+        title = function.replace("test_it_", "", 1).replace("_", " ").capitalize()
+        _AUTO_TITLES[function] = title
+        return title
 
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_collection_modifyitems(items):
+def _strip_xdist_group(nodeid):
     """
-    Allow a test to use the naming convention `test_it_does_something`. Interpret this
-    the same as if @pytest.mark.it was used.
+    Remove the "@group" suffix that pytest-xdist's --dist loadgroup adds to the nodeid
+    of each test with an xdist_group marker. This uses the same test as pytest-xdist
+    to find the suffix.
     """
-    for item in items:
-        if item.name.startswith("test_it_"):
-            if len(list(item.iter_markers(name="it"))) == 0:
-                name = item.name.split("test_it_")[1].replace("_", " ").capitalize()
-                item.add_marker(pytest.mark.it(name))
-    yield items
+    at = nodeid.rfind("@")
+    if at > nodeid.rfind("]") and at > nodeid.rfind("::"):
+        return nodeid[:at]
+    return nodeid
 
 
-class ItTerminalReporter(TerminalReporter):
+def get_spec(item):
+    """
+    Return the cached ItSpec for an item, computing it if the item wasn't seen by
+    pytest_collection_modifyitems.
+    """
+    try:
+        return item.stash[SPEC_KEY]
+    except KeyError:
+        spec = item.stash[SPEC_KEY] = ItSpec.from_item(item)
+        return spec
 
-    _current_pytest_it_fspath = None
 
-    def __init__(self, config, file=None):
-        TerminalReporter.__init__(self, config, file)
-        self._prev_item = None
-        self._showfs_path = False
+class SpecIndex(object):
+    """
+    The spec of every collected test in the session, in collection order. This is
+    public, so other plugins and tools can query the Describe/Context/It structure
+    of a run without rendering it or walking the markers again::
 
-    def _register_stats(self, report):
-        res = self.config.hook.pytest_report_teststatus(
-            report=report, config=self.config
+        index = pytest_it.get_spec_index(session)
+        index.frames("test_foo.py::test_bar")
+        # (("describe", "A foo"), ("context", "When something"))
+        index.nodeids((("describe", "A foo"),))
+        # ["test_foo.py::test_bar", ...]
+
+    A block is identified by its frames, ie. the tuple of ``(kind, text)`` pairs from
+    the outermost block inwards. The lists returned by `nodeids` are shared with the
+    index, so they must not be modified.
+
+    Internally the blocks are keyed by their id in the session's FrameTable.
+    """
+
+    def __init__(self, table=None):
+        self.table = FrameTable() if table is None else table
+        self._specs = {}
+        # Every test in each block and its nested blocks.
+        self._nodeids = {0: []}
+        self._children = {0: []}
+
+    @classmethod
+    def from_items(cls, items, table=None):
+        index = cls(table)
+        for item in items:
+            index.add(_strip_xdist_group(item.nodeid), get_spec(item))
+        return index
+
+    def add(self, nodeid, spec):
+        self._specs[nodeid] = spec
+        block = spec.frame_id
+        if block is None:
+            block, _ = self.table.intern(spec.frames)
+        parents = self.table.parents
+        while block != -1:
+            try:
+                self._nodeids[block].append(nodeid)
+            except KeyError:
+                self._nodeids[block] = [nodeid]
+                self._children.setdefault(block, [])
+                self._children.setdefault(parents[block], []).append(block)
+            block = parents[block]
+
+    def __len__(self):
+        return len(self._specs)
+
+    def __contains__(self, nodeid):
+        return nodeid in self._specs
+
+    def __iter__(self):
+        """
+        Iterate over the ``(nodeid, ItSpec)`` of each test in collection order.
+        """
+        return iter(self._specs.items())
+
+    def spec(self, nodeid):
+        """
+        The ItSpec of a test. Raises KeyError if it wasn't collected.
+        """
+        return self._specs[nodeid]
+
+    def frames(self, nodeid):
+        return self._specs[nodeid].frames
+
+    def nodeids(self, frames=()):
+        """
+        The nodeids of the tests in a block and its nested blocks, in collection
+        order. Raises KeyError if there's no such block.
+        """
+        return self._nodeids[self.table.id(frames)]
+
+    def children(self, frames=()):
+        """
+        The frames of the blocks directly inside a block, in collection order.
+        """
+        table_frames = self.table.frames
+        return [table_frames[c] for c in self._children[self.table.id(frames)]]
+
+    def blocks(self):
+        """
+        Iterate over the frames of every block, depth first in collection order.
+        """
+        stack = list(reversed(self._children[0]))
+        while stack:
+            block = stack.pop()
+            yield self.table.frames[block]
+            stack.extend(reversed(self._children[block]))
+
+    def select(self, pattern):
+        """
+        The nodeids of the tests that match an --it-select pattern. The pattern is
+        matched against the tree of blocks one level at a time, so only the blocks
+        under a matching prefix are visited, not the tests themselves.
+        """
+        title = None
+        if pattern[-1][0] == "it":
+            pattern, title = pattern[:-1], pattern[-1][1]
+        frames = self.table.frames
+        blocks = [0]
+        for kind, regex in pattern:
+            blocks = [
+                child
+                for block in blocks
+                for child in self._children[block]
+                if _frame_matches(frames[child][-1], kind, regex)
+            ]
+        if title is None:
+            return [nodeid for block in blocks for nodeid in self._nodeids[block]]
+        selected = []
+        for block in blocks:
+            for nodeid in self._nodeids[block]:
+                spec = self._specs[nodeid]
+                if spec.frames == frames[block] and title.match(
+                    (spec.title or "").lower()
+                ):
+                    selected.append(nodeid)
+        return selected
+
+
+def _frame_matches(frame, kind, regex):
+    return kind in (None, frame[0]) and regex.match(frame[1].lower())
+
+
+def get_spec_index(session):
+    """
+    The SpecIndex of the session's collected tests. It's built when the tests are
+    collected if pytest-it is in use, and otherwise on the first call. With
+    pytest-xdist it's available in the worker processes.
+    """
+    try:
+        return session.config.stash[SPEC_INDEX_KEY]
+    except KeyError:
+        index = SpecIndex.from_items(
+            getattr(session, "items", []), get_frame_table(session.config)
         )
-        self.stats.setdefault(res[0], []).append(report)
-        self._tests_ran = True
+        session.config.stash[SPEC_INDEX_KEY] = index
+        return index
 
-    def pytest_runtest_logreport(self, report):
-        self._register_stats(report)
-        if report.when != "call" and not report.skipped:
-            return
-        item = ItItem(report._item)
-        item.reconcile_and_print(self._prev_item, self._tw, report.outcome)
-        self._prev_item = item
 
-    # This is probably the best function to override. _print_collecteditems() is also a candidate, but
-    # I think it's more liable to change because it's a private method.
-    def pytest_collection_finish(self, session):
-        if self.config.getoption("collectonly"):
-            prev_it_item = None
-            for item in session.items:
-                it_item = ItItem(item)
-                it_item.reconcile_and_print(prev_it_item, self._tw, outcome=None)
-                prev_it_item = it_item
+class SpecNode(object):
+    """
+    A single Describe/Context block in a SpecTree. The header line is rendered once,
+    when the node is created.
 
-        # NOTE: this logic is copied from TerminalReporter.pytest_collection_finish
-        lines = self.config.hook.pytest_report_collectionfinish(
-            config=self.config, start_path=self.startpath, items=session.items
+    ``duration`` is the total duration of the tests in the block and its nested blocks,
+    and ``opened_at`` is its value when the block was last opened in the output.
+    Likewise ``hidden_passed`` counts the passing tests that --it-only didn't display,
+    and ``reported_passed`` is its value when the block was last closed.
+    """
+
+    __slots__ = (
+        "parent",
+        "frames",
+        "kind",
+        "text",
+        "depth",
+        "header",
+        "duration",
+        "opened_at",
+        "hidden_passed",
+        "reported_passed",
+    )
+
+    def __init__(self, parent, frames, header):
+        self.parent = parent
+        self.frames = frames
+        self.kind, self.text = frames[-1] if frames else (None, None)
+        self.depth = len(frames)
+        self.header = header
+        self.duration = 0.0
+        self.opened_at = 0.0
+        self.hidden_passed = 0
+        self.reported_passed = 0
+
+    def add_duration(self, duration):
+        node = self
+        while node is not None:
+            node.duration += duration
+            node = node.parent
+
+    def add_hidden_passed(self):
+        node = self
+        while node is not None:
+            node.hidden_passed += 1
+            node = node.parent
+
+
+class SpecTree(object):
+    """
+    Interns the Describe/Context frames of the session's tests into a tree of
+    SpecNodes, so that each block is only rendered once.
+    """
+
+    INDENT = "  "
+
+    def __init__(self):
+        self.root = SpecNode(None, (), None)
+        self._nodes = {(): self.root}
+        self._nodes_by_id = {0: self.root}
+
+    def node_for(self, frames):
+        try:
+            return self._nodes[frames]
+        except KeyError:
+            pass
+        parent = self.node_for(frames[:-1])
+        node = self._nodes[frames] = SpecNode(
+            parent, frames, self._render_header(frames)
         )
-        self._write_report_lines_from_hooks(lines)
-        if self.config.getoption("collectonly"):
-            if self.stats.get("failed"):
-                self._tw.sep("!", "collection failures")
-                for rep in self.stats.get("failed"):
-                    rep.toterminal(self._tw)
+        return node
 
-    def pytest_runtest_logstart(self, nodeid, location):
+    def node_for_spec(self, spec):
         """
-        Disable the normal running test output
+        Like node_for, but looked up by the spec's frame id where it has one.
         """
+        if spec.frame_id is None:
+            return self.node_for(spec.frames)
+        try:
+            return self._nodes_by_id[spec.frame_id]
+        except KeyError:
+            node = self._nodes_by_id[spec.frame_id] = self.node_for(spec.frames)
+            return node
+
+    def nodes(self):
+        return self._nodes.values()
+
+    def _render_header(self, frames):
+        kind, value = frames[-1]
+        if kind == "describe":
+            value = "- Describe: {}...".format(value.capitalize())
+        elif kind == "context":
+            # A nested context reads as a continuation of the enclosing one.
+            if sum(1 for f in frames if f[0] == "context") > 1:
+                value = "- ...{}...".format(_uncapitalize(value))
+            else:
+                value = "- Context: {}...".format(value.capitalize())
+        return (self.INDENT * (len(frames) - 1)) + value
+
+
+class ItFrameStack(object):
+    """
+    The Describe/Context blocks that are currently open in the output.
+    """
+
+    __slots__ = ("tree", "node", "module", "show_durations", "show_passed", "grouped")
+
+    def __init__(self, tree, show_durations=False, show_passed=False, grouped=False):
+        self.tree = tree
+        self.node = tree.root
+        self.module = None
+        self.show_durations = show_durations
+        self.show_passed = show_passed
+        # Each block is only opened once, so show its whole duration when it closes.
+        self.grouped = grouped
+
+    def move_to(self, node):
+        """
+        Make `node` the innermost open block. Return the blocks that are closed,
+        innermost first, and the blocks that are opened, outermost first. Only the
+        blocks that differ from the current stack are visited.
+        """
+        target, current, closed, opened = node, self.node, [], []
+        while node.depth > current.depth:
+            opened.append(node)
+            node = node.parent
+        while current.depth > node.depth:
+            closed.append(current)
+            current = current.parent
+        while current is not node:
+            closed.append(current)
+            opened.append(node)
+            node, current = node.parent, current.parent
+        opened.reverse()
+        for block in opened:
+            block.opened_at = block.duration
+        self.node = target
+        return closed, opened
+
+    def print_closed(self, closed, tw):
+        """
+        Print the summary line for each block that's been closed, if there is one.
+        """
+        if not (self.show_durations or self.show_passed):
+            return
+        for block in closed:
+            summary = []
+            if self.show_passed:
+                passed = block.hidden_passed - block.reported_passed
+                block.reported_passed = block.hidden_passed
+                if passed:
+                    summary.append("{} passed".format(passed))
+            if self.show_durations:
+                duration = block.duration
+                if not self.grouped:
+                    duration -= block.opened_at
+                summary.append("{:.2f}s".format(duration))
+            if summary:
+                tw.line(
+                    "{}({})".format(SpecTree.INDENT * block.depth, ", ".join(summary))
+                )
+
+    def close_all(self, tw):
+        """
+        Close all of the open blocks, printing their summary lines.
+        """
+        closed, _ = self.move_to(self.tree.root)
+        self.print_closed(closed, tw)
+
+    def reconcile(self, node, module, tw):
+        """
+        Print the Describe/Context headers from the point where the block hierarchy
+        differs from the previous test, ready to print a test in `node`.
+        """
+        prev_node = self.node
+        is_first_module_test = module != self.module
+        closed, opened = self.move_to(node)
+        self.module = module
+        self.print_closed(closed, tw)
+        for block in opened:
+            if block.depth <= 3:
+                tw.sep(" ")
+            tw.line(block.header)
+
+        # Print a separator before the test if this test is displayed after a deeper block.
+        if not opened and node.depth < prev_node.depth:
+            tw.sep(" ")
+        # If this is a new module, add a separate to avoid printing "* my_module.py... It: does something"
+        # on a single line.
+        elif node.depth == 0 and is_first_module_test:
+            tw.sep(" ")
+
+
+class CollectionOrder(object):
+    """
+    pytest-xdist reports the tests in the order they finish on the workers. This holds
+    back the work for each test (as callables) and releases it in collection order,
+    so that the output doesn't break up the Describe/Context blocks.
+
+    It's only active once pytest-xdist has reported the collected nodeids.
+    """
+
+    def __init__(self):
+        self.nodeids = None
+        self._cursor = 0
+        self._held = {}
+        self._finished = set()
+
+    @property
+    def active(self):
+        return self.nodeids is not None
+
+    def set_nodeids(self, nodeids):
+        if self.nodeids is None:
+            self.nodeids = list(nodeids)
+
+    def hold(self, nodeid, func, *args):
+        self._held.setdefault(nodeid, []).append(functools.partial(func, *args))
+
+    def finish(self, nodeid):
+        self._finished.add(nodeid)
+
+    def release(self, finished_only=False):
+        """
+        Run the held work in collection order. If finished_only is True, stop at the
+        first test in the collection order that hasn't finished yet.
+        """
+        if self.nodeids is None:
+            return
+        while self._cursor < len(self.nodeids):
+            nodeid = self.nodeids[self._cursor]
+            if finished_only and nodeid not in self._finished:
+                return
+            self._finished.discard(nodeid)
+            self._cursor += 1
+            for func in self._held.pop(nodeid, ()):
+                func()
+        # Anything left wasn't part of the collected ids, eg. a report for a crashed
+        # worker.
+        for nodeid in list(self._held):
+            for func in self._held.pop(nodeid):
+                func()
+
+
+class ItResult(object):
+    """
+    The combined result of the setup, call and teardown reports of one test.
+    """
+
+    __slots__ = ("nodeid", "spec", "outcome", "duration", "attempts")
+
+    def __init__(self, nodeid, spec):
+        self.nodeid = nodeid
+        self.spec = spec
+        self.outcome = None
+        self.duration = 0.0
+        self.attempts = 1
+
+    def update(self, report):
+        self.duration += report.duration
+        if report.outcome == "rerun":
+            self.outcome = "rerun"
+        elif report.when == "call":
+            if self.outcome != "error":
+                self.outcome = report.outcome
+        elif report.failed:
+            if self.outcome in (None, "passed"):
+                self.outcome = "error"
+        elif report.skipped:
+            self.outcome = "skipped"
+
+    def to_json(self):
+        return {
+            "nodeid": self.nodeid,
+            "frames": [list(f) for f in self.spec.frames],
+            "title": self.spec.title,
+            "outcome": self.outcome,
+            "duration": self.duration,
+            "attempts": self.attempts,
+        }
+
+
+def _uncapitalize(s):
+    return s[0].lower() + s[1:]
+
+
+class ItItem(object):
+
+    INDENT = "  "
+    COLORS = {
+        "reset": "\033[0m",
+        "passed": "\033[92m",
+        "failed": "\033[91m",
+        "skipped": "\033[93m",
+    }
+
+    def __init__(self, spec, nodeid, location, config, attempts=1):
+        assert spec
+        self.spec = spec
+        self.nodeid = nodeid
+        self.location = location
+        self.config = config
+        # How many times the test ran, when it was rerun (eg. by pytest-rerunfailures).
+        self.attempts = attempts
+
+    @classmethod
+    def from_item(cls, item):
+        return cls(get_spec(item), item.nodeid, item.location, item.config)
+
+    @classmethod
+    def from_report(cls, report, config):
+        spec = getattr(report, "_it_spec", None) or ItSpec.from_nodeid(report.nodeid)
+        nodeid = _strip_xdist_group(report.nodeid)
+        return cls(spec, nodeid, report.location, config)
+
+    @property
+    def name(self):
+        return self.nodeid.split("::")[-1]
+
+    @property
+    def path(self):
+        """Path to the test"""
+
+        # TODO: docstrings show up in the path. This is used for verbose mode. Should only show
+        # the actual path without docstrings.
+        return "::".join(self.nodeid.split("::")[:-1])
+
+    def formatted_result(self, outcome):
+        icons = {"passed": "- ✓", "failed": "- F", "skipped": "- s"}
+        title = self.spec.title
+        if title:
+            prefix = "It:"
+        else:
+            prefix = ""
+            title = self.name
+        try:
+            if "[doctest]" in self.location[-1]:
+                title = self.name + " - [doctest]"
+        except IndexError:
+            pass
+        if self.config.option.verbose > 0:
+            title = self.path + "::{} - {}".format(self.name, title)
+        if self.spec.param is not None:  # Parametrised test
+            title = title + " - [{}]".format(self.spec.param)
+        if self.attempts > 1:
+            title = title + " ({} attempts)".format(self.attempts)
+        return "{color}{icon}{prefix}{reset} {title}".format(
+            color=self.color(outcome),
+            reset=self.color("reset"),
+            icon=icons.get(outcome, "-"),
+            prefix=" " + prefix if prefix else "",
+            title=title,
+        )
+
+    @property
+    def parent_marks(self):
+        return self.spec.frames
+
+    def color(self, s):
+        if self.config.option.it_color in (True, None):
+            return self.COLORS.get(s, self.COLORS["skipped"])
+        return ""
+
+    @property
+    def module(self):
+        return self.spec.module
+
+    def reconcile_and_print(self, stack, tw, outcome):
+        node = stack.tree.node_for_spec(self.spec)
+        stack.reconcile(node, self.module, tw)
+        tw.line(self.formatted_line(node, outcome))
+
+    def formatted_line(self, node, outcome):
+        """
+        The result with the indent for its block.
+        """
+        return (self.INDENT * node.depth) + self.formatted_result(outcome)
+
+
+class ItPlugin(object):
+    """
+    The per-test hooks. These are only registered if one of the pytest-it options is
+    used, so that having pytest-it installed costs nothing for other runs.
+    """
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        result = yield
+        report = result.get_result()
+        # Only attach the spec, so the report doesn't keep the Item (and its fixtures)
+        # alive for the rest of the session.
+        report._it_spec = get_spec(item)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_report_to_serializable(self, config, report):
+        """
+        Convert the spec to plain data so it can be sent over the pytest-xdist channel.
+        """
+        result = yield
+        data = result.get_result()
+        if data is not None and isinstance(data.get("_it_spec"), ItSpec):
+            data["_it_spec"] = data["_it_spec"].to_json()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_report_from_serializable(self, config, data):
+        result = yield
+        report = result.get_result()
+        if isinstance(getattr(report, "_it_spec", None), dict):
+            report._it_spec = ItSpec.from_json(report._it_spec, get_frame_table(config))
+
+    def pytest_sessionfinish(self, session):
+        reporter = session.config.pluginmanager.getplugin("terminalreporter")
+        if isinstance(reporter, ItTerminalReporter):
+            # Runs before the terminal reporter prints the failure sections and summary.
+            reporter.finish_spec()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if isinstance(terminalreporter, ItTerminalReporter):
+            terminalreporter.summary_it_durations()
+            terminalreporter.summary_it_flaky()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_collection_modifyitems(self, config, items):
+        """
+        Once the other plugins have modified the items, resolve and cache each item's
+        ItSpec so the reporter doesn't need to walk the markers again, and build the
+        session's SpecIndex.
+
+        The xdist_group markers for --it-dist-group are added before the other
+        plugins run, so that pytest-xdist can see them.
+
+        A test can use the naming convention `test_it_does_something`. This is
+        interpreted the same as if @pytest.mark.it was used, but the title is only
+        derived from the name when a report needs it (see ItSpec.title).
+        """
+        if config.option.it_dist_group:
+            self._add_dist_groups(items, config.option.it_dist_group)
+        yield items
+        self._modify_items(config, items)
+
+    def _modify_items(self, config, items):
+        index = config.stash[SPEC_INDEX_KEY] = SpecIndex(get_frame_table(config))
+        for item in items:
+            index.add(_strip_xdist_group(item.nodeid), get_spec(item))
+        if config.option.it_select:
+            self._deselect(config, index, items)
+        if config.option.it_shard:
+            self._shard(config, items)
+
+    def _add_dist_groups(self, items, depth):
+        for item in items:
+            # Not get_spec(), which would cache the spec before the other plugins'
+            # hooks have added their markers.
+            frames = ItSpec.from_item(item).frames[:depth]
+            if frames:
+                name = "/".join(text for _, text in frames)
+                item.add_marker(pytest.mark.xdist_group(name))
+
+    def _shard(self, config, items):
+        """
+        Assign each top-level block to a shard greedily, largest predicted duration
+        first, and deselect the items that aren't in this run's shard.
+        """
+        k, n = config.option.it_shard
+        history = ItDurationHistory.load(getattr(config, "cache", None))
+        units = {}
+        for item in items:
+            unit = ItDurationHistory.block_for(get_spec(item))[:1]
+            units.setdefault(unit, []).append(item)
+        averages = {unit: history.get(ItDurationHistory.key(unit)) for unit in units}
+        known = [average for average in averages.values() if average is not None]
+        # Blocks without any history are assumed to have the average test duration.
+        default = sum(known) / len(known) if known else 1.0
+        predicted = []
+        for i, (unit, unit_items) in enumerate(units.items()):
+            average = averages[unit]
+            if average is None:
+                average = default
+            # Ties are broken by collection order, so every shard agrees on the split.
+            predicted.append((-len(unit_items) * average, i, unit))
+        predicted.sort()
+        loads = [0.0] * n
+        shards = {}
+        for duration, _, unit in predicted:
+            shard = loads.index(min(loads))
+            loads[shard] -= duration
+            shards[unit] = shard
+        remaining, deselected = [], []
+        for unit, unit_items in units.items():
+            (remaining if shards[unit] == k - 1 else deselected).extend(unit_items)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            # Keep the collection order, rather than grouping the items by block.
+            remaining = set(remaining)
+            items[:] = [item for item in items if item in remaining]
+
+    def _deselect(self, config, index, items):
+        selected = set()
+        for pattern in config.option.it_select:
+            selected.update(index.select(pattern))
+        remaining, deselected = [], []
+        for item in items:
+            nodeid = _strip_xdist_group(item.nodeid)
+            (remaining if nodeid in selected else deselected).append(item)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = remaining
+
+
+class ItJsonlWriter(object):
+    """
+    Stream one JSON record per test to a file as the tests finish. Only the tests that
+    are currently running are held in memory.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = os.path.normpath(os.path.abspath(os.path.expanduser(path)))
+        self._file = None
+        self._running = {}
+
+    def pytest_sessionstart(self, session):
+        self._file = _open_output(self.path, self.BUFFER_SIZE)
+
+    def pytest_runtest_logreport(self, report):
+        result = _update_result(self._running, report)
+        if result is not None:
+            self._write(result)
+
+    def _write(self, result):
+        self._file.write(json.dumps(result.to_json(), ensure_ascii=False))
+        self._file.write("\n")
+
+    def pytest_sessionfinish(self, session):
+        if self._file is None:
+            return
+        # Tests that never reached teardown, eg. because their xdist worker crashed.
+        for result in self._running.values():
+            self._write(result)
+        self._running = {}
+        self._file.close()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "generated it-jsonl file: {}".format(self.path))
+
+
+def _open_output(path, buffering):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return open(path, "w", encoding="utf-8", buffering=buffering)
+
+
+def _update_result(running, report):
+    """
+    Add the report to the ItResult of its test in `running`. Once the test has
+    finished, remove its result and return it. A test that's rerun (eg. by
+    pytest-rerunfailures) only finishes after its final attempt.
+    """
+    try:
+        result = running[report.nodeid]
+    except KeyError:
+        spec = getattr(report, "_it_spec", None) or ItSpec.from_nodeid(report.nodeid)
+        nodeid = _strip_xdist_group(report.nodeid)
+        result = running[report.nodeid] = ItResult(nodeid, spec)
+    result.update(report)
+    if report.when != "teardown":
+        return None
+    if result.outcome == "rerun":
+        result.outcome = None
+        result.attempts += 1
+        return None
+    del running[report.nodeid]
+    return result
+
+
+class ItSnapshot(object):
+    """
+    Save a snapshot of the run's spec, and compare it with a previous snapshot for
+    --it-diff.
+
+    A snapshot is a list of ``[hash, path, outcome]`` entries sorted by hash, where
+    path is the module and Describe/Context/It path of a test. Two snapshots are
+    compared by merging the sorted lists, so it takes linear time.
+    """
+
+    CACHE_KEY = "pytest_it/snapshot"
+    VERSION = 1
+
+    def __init__(self, config):
+        self.cache = getattr(config, "cache", None)
+        self.path = config.option.it_snapshot
+        if self.path is not None:
+            self.path = os.path.normpath(os.path.abspath(os.path.expanduser(self.path)))
+        self.diff_path = config.option.it_diff
+        self._baseline = None
+        self._running = {}
+        self._entries = []
+        self._diff = None
+
+    def pytest_sessionstart(self, session):
+        # Load the baseline before this run's snapshot replaces it in the cache.
+        if self.diff_path is not None:
+            self._baseline = self.load(self.diff_path)
+
+    def load(self, snapshot):
+        if snapshot == "last":
+            data = self.cache.get(self.CACHE_KEY, None) if self.cache else None
+        else:
+            try:
+                with open(os.path.expanduser(snapshot), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                raise pytest.UsageError(
+                    "could not read --it-diff snapshot {}: {}".format(snapshot, e)
+                )
+        if not data or data.get("version") != self.VERSION:
+            return []
+        return [tuple(entry) for entry in data["entries"]]
+
+    @staticmethod
+    def path_for(result):
+        spec = result.spec
+        parts = [spec.module]
+        parts.extend(_frame_titles(spec.frames))
+        parts.append(ExportWriter.result_title(result))
+        return " / ".join(parts)
+
+    def pytest_runtest_logreport(self, report):
+        result = _update_result(self._running, report)
+        if result is not None:
+            self._add(result)
+
+    def _add(self, result):
+        path = self.path_for(result)
+        key = hashlib.blake2b(path.encode("utf-8"), digest_size=8).hexdigest()
+        self._entries.append((key, path, result.outcome))
+
+    def pytest_sessionfinish(self, session):
+        for result in self._running.values():
+            self._add(result)
+        self._running = {}
+        if not self._entries:
+            return
+        self._entries.sort()
+        if self._baseline is not None:
+            self._diff = sorted(diff_snapshots(self._baseline, self._entries))
+        data = {"version": self.VERSION, "entries": self._entries}
+        if self.cache is not None:
+            self.cache.set(self.CACHE_KEY, data)
+        if self.path is not None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        tr = terminalreporter
+        if self._diff is not None:
+            tr.write_sep("=", "pytest-it diff against {}".format(self.diff_path))
+            for path, sign, old, new in self._diff:
+                if sign == "~":
+                    line = "~ {} ({} -> {})".format(path, old, new)
+                else:
+                    line = "{} {} ({})".format(sign, path, old or new)
+                tr.write_line(
+                    line, red=sign == "-", green=sign == "+", yellow=sign == "~"
+                )
+            if not self._diff:
+                tr.write_line("no changes")
+        if self.path is not None:
+            tr.write_sep("-", "generated it-snapshot file: {}".format(self.path))
+
+
+def _frame_titles(frames):
+    return ["{}: {}".format(k.capitalize(), t.capitalize()) for k, t in frames]
+
+
+def diff_snapshots(old, new):
+    """
+    Merge two snapshots that are sorted by hash, and yield ``(path, sign, old_outcome,
+    new_outcome)`` for each test that was removed ("-"), added ("+") or changed
+    outcome ("~").
+    """
+    i = j = 0
+    while i < len(old) and j < len(new):
+        old_key, old_path, old_outcome = old[i]
+        new_key, new_path, new_outcome = new[j]
+        if (old_key, old_path) == (new_key, new_path):
+            if old_outcome != new_outcome:
+                yield new_path, "~", old_outcome, new_outcome
+            i += 1
+            j += 1
+        elif (old_key, old_path) < (new_key, new_path):
+            yield old_path, "-", old_outcome, None
+            i += 1
+        else:
+            yield new_path, "+", None, new_outcome
+            j += 1
+    for _, path, outcome in old[i:]:
+        yield path, "-", outcome, None
+    for _, path, outcome in new[j:]:
+        yield path, "+", None, outcome
+
+
+class ItCoverageContexts(object):
+    """
+    Switch the coverage.py dynamic context when the tests move into a different
+    Describe/Context block, for --it-coverage-contexts. There's one context per block
+    rather than one per test, which keeps the number of contexts and the switching
+    overhead down. Tests that aren't in any block use their module as the context.
+
+    This runs in the process that runs the tests, so with pytest-xdist the contexts are
+    switched on the workers, but the summary can only be shown if the controller
+    measured the tests itself.
+    """
+
+    def __init__(self):
+        self._coverage = None
+        self._block = None
+        self._contexts = set()
+
+    def pytest_sessionstart(self, session):
+        try:
+            import coverage
+        except ImportError:
+            return
+        self._coverage = coverage.Coverage.current()
+
+    @pytest.hookimpl(hookwrapper=True, tryfirst=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        if self._coverage is None:
+            yield
+            return
+        spec = get_spec(item)
+        block = spec.frame_id if spec.frames else spec.module
+        if block != self._block:
+            self._block = block
+            context = " / ".join(_frame_titles(spec.frames)) or spec.module
+            self._contexts.add(context)
+            self._coverage.switch_context(context)
+        yield
+        # Reset the context after the last test rather than at the end of the session,
+        # because pytest-cov stops coverage at the end of the test loop.
+        if nextitem is None:
+            self._coverage.switch_context("")
+            self._block = None
+
+    def summary(self, config=None):
+        """
+        Return ``(context, lines, unique)`` for each block, where unique is the number
+        of lines that no other block covers.
+        """
+        lines = dict.fromkeys(self._contexts, 0)
+        unique = dict.fromkeys(self._contexts, 0)
+        data = self._measured(config).get_data()
+        # pytest-it's own code runs inside the contexts too, when it reports results.
+        own_file = os.path.abspath(__file__)
+        for filename in data.measured_files():
+            if os.path.abspath(filename) == own_file:
+                continue
+            for contexts in data.contexts_by_lineno(filename).values():
+                blocks = [c for c in contexts if c in lines]
+                for context in blocks:
+                    lines[context] += 1
+                if len(blocks) == 1:
+                    unique[blocks[0]] += 1
+        return sorted(
+            ((context, lines[context], unique[context]) for context in lines),
+            key=lambda row: (-row[1], row[0]),
+        )
+
+    def _measured(self, config):
+        """
+        pytest-cov saves the data at the end of the test loop and combines it into
+        another Coverage object, so read it from that one.
+        """
+        plugin = config.pluginmanager.getplugin("_cov") if config else None
+        controller = getattr(plugin, "cov_controller", None)
+        if controller is not None and controller.cov is not None:
+            return controller.cov
+        return self._coverage
+
+    def pytest_terminal_summary(self, terminalreporter):
+        tr = terminalreporter
+        if self._coverage is None:
+            if not hasattr(tr.config, "workerinput"):
+                tr.write_sep("-", "--it-coverage-contexts: coverage.py isn't running")
+            return
+        if not self._contexts:
+            return
+        tr.write_sep("=", "pytest-it coverage by block")
+        tr.write_line("{:>8}{:>8}  {}".format("lines", "unique", "block"))
+        for context, lines, unique in self.summary(tr.config):
+            tr.write_line("{:>8}{:>8}  {}".format(lines, unique, context))
+
+
+class ItExporter(object):
+    """
+    Stream the spec to one or more documents as the tests finish. The blocks are
+    opened and closed with an ItFrameStack in the same way as the terminal output,
+    so only the open blocks and the tests that are currently running are held in
+    memory. Under pytest-xdist, the results are written in collection order like the
+    terminal output, so only the results that finished out of order are held too.
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+        self._stack = ItFrameStack(SpecTree())
+        self._running = {}
+        self._order = CollectionOrder()
+
+    def pytest_sessionstart(self, session):
+        for writer in self.writers:
+            writer.open()
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_node_collection_finished(self, node, ids):
+        self._order.set_nodeids(ids)
+
+    def pytest_runtest_logreport(self, report):
+        result = _update_result(self._running, report)
+        if result is None:
+            return
+        if self._order.active:
+            self._order.hold(report.nodeid, self._write, result)
+        else:
+            self._write(result)
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        # A test that's being rerun is still running until its final attempt.
+        if self._order.active and nodeid not in self._running:
+            self._order.finish(nodeid)
+            self._order.release(finished_only=True)
+
+    def _write(self, result):
+        closed, opened = self._stack.move_to(
+            self._stack.tree.node_for_spec(result.spec)
+        )
+        node = self._stack.node
+        for writer in self.writers:
+            for block in closed:
+                writer.close_block(block)
+            for block in opened:
+                writer.open_block(block)
+            if closed and not opened and node.depth:
+                writer.resume_block(node)
+            writer.write_result(result, node.depth)
+
+    def pytest_sessionfinish(self, session):
+        if not self.writers or self.writers[0].file is None:
+            return
+        self._order.release()
+        for result in self._running.values():
+            self._write(result)
+        self._running = {}
+        closed, _ = self._stack.move_to(self._stack.tree.root)
+        for writer in self.writers:
+            for block in closed:
+                writer.close_block(block)
+            writer.close()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        for writer in self.writers:
+            terminalreporter.write_sep(
+                "-",
+                "generated it-export {} file: {}".format(writer.FORMAT, writer.path),
+            )
+
+
+class ExportWriter(object):
+    """
+    Base class for the --it-export formats. Subclasses write each part of the
+    document straight to the file as it's reached.
+    """
+
+    FORMAT = None
+    BUFFER_SIZE = 64 * 1024
+    ICONS = {"passed": "✓", "failed": "F", "skipped": "s", "error": "E"}
+
+    def __init__(self, path):
+        self.path = os.path.normpath(os.path.abspath(os.path.expanduser(path)))
+        self.file = None
+
+    def open(self):
+        self.file = _open_output(self.path, self.BUFFER_SIZE)
+        self.write_start()
+
+    def close(self):
+        self.write_end()
+        self.file.close()
+
+    @staticmethod
+    def block_title(node):
+        return "{}: {}".format(node.kind.capitalize(), node.text.capitalize())
+
+    @staticmethod
+    def result_title(result):
+        spec = result.spec
+        title = spec.title
+        title = "It: " + title if title else result.nodeid.split("::")[-1]
+        if spec.param is not None:
+            title = title + " - [{}]".format(spec.param)
+        return title
+
+    def write_start(self):
+        pass
+
+    def write_end(self):
+        pass
+
+    def open_block(self, node):
+        raise NotImplementedError
+
+    def close_block(self, node):
+        pass
+
+    def resume_block(self, node):
+        """
+        Called when a test follows a nested block that's been closed.
+        """
+        pass
+
+    def write_result(self, result, depth):
+        raise NotImplementedError
+
+
+class OrgExportWriter(ExportWriter):
+
+    FORMAT = "org"
+
+    def open_block(self, node):
+        self.file.write("{} {}\n".format("*" * node.depth, self.block_title(node)))
+
+    # Headings can't be closed, so repeat the heading of the block the test is in.
+    resume_block = open_block
+
+    def write_result(self, result, depth):
+        self.file.write(
+            "- {} {}\n".format(
+                self.ICONS.get(result.outcome, "-"), self.result_title(result)
+            )
+        )
+
+
+class MarkdownExportWriter(ExportWriter):
+
+    FORMAT = "markdown"
+
+    def __init__(self, path):
+        super(MarkdownExportWriter, self).__init__(path)
+        self._in_list = False
+
+    @staticmethod
+    def escape(s):
+        return "".join("\\" + c if c in "\\`*_[]<>#" else c for c in s)
+
+    def open_block(self, node):
+        self.file.write(
+            "{}{} {}\n\n".format(
+                "\n" if self._in_list else "",
+                "#" * min(node.depth, 6),
+                self.escape(self.block_title(node)),
+            )
+        )
+        self._in_list = False
+
+    resume_block = open_block
+
+    def write_result(self, result, depth):
+        self._in_list = True
+        self.file.write(
+            "- {} {}\n".format(
+                self.ICONS.get(result.outcome, "-"),
+                self.escape(self.result_title(result)),
+            )
+        )
+
+
+class HtmlExportWriter(ExportWriter):
+
+    FORMAT = "html"
+    HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>pytest-it</title>
+<style>
+section { margin-left: 1.5em; }
+p { margin: 0.2em 0; }
+.passed { color: #080; }
+.failed, .error { color: #c00; }
+.skipped { color: #a60; }
+</style>
+</head>
+<body>
+"""
+
+    def write_start(self):
+        self.file.write(self.HEAD)
+
+    def write_end(self):
+        self.file.write("</body>\n</html>\n")
+
+    def open_block(self, node):
+        self.file.write(
+            '<section class="{}">\n<h{}>{}</h{}>\n'.format(
+                node.kind,
+                min(node.depth, 6),
+                html.escape(self.block_title(node)),
+                min(node.depth, 6),
+            )
+        )
+
+    def close_block(self, node):
+        self.file.write("</section>\n")
+
+    def write_result(self, result, depth):
+        self.file.write(
+            '<p class="{}">{} {}</p>\n'.format(
+                result.outcome,
+                self.ICONS.get(result.outcome, "-"),
+                html.escape(self.result_title(result)),
+            )
+        )
+
+
+EXPORT_FORMATS = {
+    cls.FORMAT: cls for cls in (OrgExportWriter, MarkdownExportWriter, HtmlExportWriter)
+}
+
+
+class ItDurationHistory(object):
+    """
+    Record the average duration of the tests in each Describe/Context block in the
+    pytest cache, as an exponentially weighted average across runs. This is used by
+    --it-shard to predict the duration of each block.
+
+    The average is per test, so a run that only selects some of a block's tests
+    doesn't skew it. Tests that aren't in any block are recorded against their module.
+    """
+
+    CACHE_KEY = "pytest_it/durations"
+    ALPHA = 0.3
+
+    def __init__(self, cache):
+        self.cache = cache
+        # The total duration and number of tests for each innermost block.
+        self._blocks = {}
+
+    @staticmethod
+    def block_for(spec):
+        return spec.frames or (("module", spec.module),)
+
+    @staticmethod
+    def key(frames):
+        return json.dumps([list(f) for f in frames], ensure_ascii=False)
+
+    @classmethod
+    def load(cls, cache):
+        if cache is None:
+            return {}
+        return cache.get(cls.CACHE_KEY, {})
+
+    def pytest_runtest_logreport(self, report):
+        spec = getattr(report, "_it_spec", None) or ItSpec.from_nodeid(report.nodeid)
+        block = self.block_for(spec)
+        try:
+            totals = self._blocks[block]
+        except KeyError:
+            totals = self._blocks[block] = [0.0, 0]
+        totals[0] += report.duration
+        if report.when == "teardown":
+            totals[1] += 1
+
+    def pytest_sessionfinish(self, session):
+        if not self._blocks:
+            return
+        totals = {}
+        for block, (duration, count) in self._blocks.items():
+            for i in range(1, len(block) + 1):
+                try:
+                    block_totals = totals[block[:i]]
+                except KeyError:
+                    block_totals = totals[block[:i]] = [0.0, 0]
+                block_totals[0] += duration
+                block_totals[1] += count
+        history = self.load(self.cache)
+        for block, (duration, count) in totals.items():
+            if not count:
+                continue
+            key = self.key(block)
+            average = duration / count
+            previous = history.get(key)
+            if previous is not None:
+                average = self.ALPHA * average + (1 - self.ALPHA) * previous
+            history[key] = average
+        self.cache.set(self.CACHE_KEY, history)
+
+
+class ItCollectCache(object):
+    """
+    Persist the spec of every collected test module in the pytest cache, keyed by the
+    module's path, mtime and size. Unchanged modules are then skipped during
+    collection, and their cached spec is rendered instead.
+    """
+
+    CACHE_KEY = "pytest_it/spec_tree"
+
+    def __init__(self, config):
+        self.config = config
+        self._entries = config.cache.get(self.CACHE_KEY, {})
+        self._reused = set()
+        # The module paths in collection order, both reused and re-collected.
+        self._order = []
+        # pytest checks every entry of the directories it walks to reach the given
+        # paths, so only modules under one of them are reused.
+        invocation_dir = str(config.invocation_params.dir)
+        self._roots = [
+            os.path.normpath(os.path.join(invocation_dir, arg)) for arg in config.args
+        ]
+
+    @staticmethod
+    def is_enabled(config):
+        """
+        The cache can't apply -k, -m, --it-select, --it-shard or nodeid selection to
+        the modules it doesn't collect, so don't use it if any of them are given.
+        """
+        if not (config.option.it_collect_cached and config.option.collectonly):
+            return False
+        if getattr(config, "cache", None) is None:
+            return False
+        option = config.option
+        if option.keyword or option.markexpr or option.deselect:
+            return False
+        if option.it_select or option.it_shard:
+            return False
+        return not any("::" in arg for arg in config.args)
+
+    @property
+    def cached_count(self):
+        return sum(len(self._entries[path]["items"]) for path in self._reused)
+
+    def pytest_ignore_collect(self, collection_path, config):
+        path = str(collection_path)
+        entry = self._entries.get(path)
+        if entry is None or not self._is_requested(path):
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+            return None
+        self._reused.add(path)
+        self._order.append(path)
+        return True
+
+    def _is_requested(self, path):
+        for root in self._roots:
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+    def pytest_collect_file(self, file_path, parent):
+        self._order.append(str(file_path))
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_collection(self, session):
+        yield
+        # Otherwise the session would exit with "no tests collected" if every module
+        # was reused.
+        session.testscollected += self.cached_count
+
+    def it_items(self, items):
+        """
+        Merge the collected items with the cached modules, in collection order.
+        """
+        collected = {}
+        for item in items:
+            collected.setdefault(str(item.path), []).append(ItItem.from_item(item))
+        table = get_frame_table(self.config)
+        for path in self._order:
+            if path in self._reused:
+                for nodeid, location, spec in self._entries[path]["items"]:
+                    yield ItItem(
+                        ItSpec.from_json(spec, table),
+                        nodeid,
+                        tuple(location),
+                        self.config,
+                    )
+            else:
+                for it_item in collected.pop(path, ()):
+                    yield it_item
+        for it_items in collected.values():
+            for it_item in it_items:
+                yield it_item
+
+    def save(self, items):
+        collected = {}
+        for item in items:
+            collected.setdefault(str(item.path), []).append(
+                [item.nodeid, list(item.location), get_spec(item).to_json()]
+            )
+        for path in self._order:
+            if path in self._reused:
+                continue
+            self._entries.pop(path, None)
+            if path in collected:
+                st = os.stat(path)
+                self._entries[path] = {
+                    "mtime": st.st_mtime,
+                    "size": st.st_size,
+                    "items": collected[path],
+                }
+        self.config.cache.set(self.CACHE_KEY, self._entries)
+
+
+class ItProfile(object):
+    """
+    Time pytest-it's own code paths, for --it-profile. The methods of each phase are
+    replaced with timed wrappers for the run, so nothing is measured (or costs
+    anything) unless profiling is on.
+
+    The time of a phase excludes the phases nested inside it, eg. the marker
+    resolution during collection, so the phases add up to the total overhead.
+    """
+
+    PHASES = (
+        "markers",
+        "collection",
+        "reconcile_and_print",
+        "terminal writes",
+        "_register_stats",
+    )
+
+    def __init__(self, json_path=None):
+        self.json_path = json_path
+        if json_path is not None:
+            self.json_path = os.path.normpath(
+                os.path.abspath(os.path.expanduser(json_path))
+            )
+        self.phases = {phase: [0.0, 0] for phase in self.PHASES}
+        # The time of the phases nested inside the current one. This is per thread,
+        # because BufferedFile's timer thread writes to the terminal too.
+        self._local = threading.local()
+        self._patched = []
+        self._start = time.perf_counter()
+        self._session_duration = None
+
+    def timed(self, phase, func):
+        totals = self.phases[phase]
+
+        def wrapper(*args, **kwargs):
+            local = self._local
+            start = time.perf_counter()
+            nested, local.nested = getattr(local, "nested", 0.0), 0.0
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                totals[0] += elapsed - local.nested
+                totals[1] += 1
+                local.nested = nested + elapsed
+
+        return wrapper
+
+    def patch(self, obj, name, phase):
+        self._patched.append((obj, name, vars(obj).get(name)))
+        setattr(obj, name, self.timed(phase, getattr(obj, name)))
+
+    def instrument(self, config):
+        self.patch(ItSpec, "from_item", "markers")
+        self.patch(ItItem, "reconcile_and_print", "reconcile_and_print")
+        plugin = config.pluginmanager.getplugin("it-plugin")
+        if plugin is not None:
+            self.patch(plugin, "_add_dist_groups", "collection")
+            self.patch(plugin, "_modify_items", "collection")
+        reporter = config.pluginmanager.getplugin("terminalreporter")
+        if isinstance(reporter, ItTerminalReporter):
+            self.patch(reporter, "_register_stats", "_register_stats")
+            tw = reporter._tw
+            # Time the writes to the terminal itself, rather than to the buffer.
+            if isinstance(tw._file, BufferedFile):
+                tw._file._out = ProfiledFile(tw._file._out, self)
+            else:
+                tw._file = ProfiledFile(tw._file, self)
+
+    def pytest_sessionstart(self, session):
+        self._start = time.perf_counter()
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_sessionfinish(self, session):
+        self._session_duration = time.perf_counter() - self._start
+
+    def to_json(self):
+        return {
+            "session": self._session_duration,
+            "phases": {
+                phase: {"total": total, "calls": calls}
+                for phase, (total, calls) in self.phases.items()
+            },
+        }
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_terminal_summary(self, terminalreporter):
+        tr = terminalreporter
+        tr.write_sep("=", "pytest-it profile")
+        tr.write_line(
+            "{:<22}{:>10}{:>12}{:>12}".format("phase", "calls", "total", "per call")
+        )
+        overhead = 0.0
+        for phase, (total, calls) in self.phases.items():
+            overhead += total
+            tr.write_line(
+                "{:<22}{:>10}{:>10.1f}ms{:>10.1f}us".format(
+                    phase, calls, total * 1e3, total / calls * 1e6 if calls else 0.0
+                )
+            )
+        session = self._session_duration or time.perf_counter() - self._start
+        tr.write_line(
+            "{:<32}{:>10.1f}ms ({:.1%} of {:.2f}s)".format(
+                "total", overhead * 1e3, overhead / session if session else 0.0, session
+            )
+        )
+        if self.json_path is not None:
+            dirname = os.path.dirname(self.json_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.json_path, "w") as f:
+                json.dump(self.to_json(), f, indent=2)
+            tr.write_sep("-", "generated it-profile file: {}".format(self.json_path))
+
+    def pytest_unconfigure(self, config):
+        for obj, name, original in reversed(self._patched):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self._patched = []
+
+
+class ProfiledFile(object):
+    """
+    Wrap a file to time its writes, for --it-profile.
+    """
+
+    def __init__(self, file, profile):
+        self._file = file
+        self.write = profile.timed("terminal writes", file.write)
+        self.flush = profile.timed("terminal writes", file.flush)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _duplicate_output(file):
+    """
+    pytest redirects the stdout file descriptor to capture the output of each test, so
+    return a file that writes to a copy of it. Otherwise anything written while a test
+    is running would be captured along with the test's own output.
+    """
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return file
+    file.flush()
+    return open(
+        os.dup(fd),
+        "w",
+        encoding=getattr(file, "encoding", None) or "utf-8",
+        errors=getattr(file, "errors", None) or "strict",
+    )
+
+
+class BufferedFile(object):
+    """
+    Wrap the terminal reporter's file to coalesce many small writes into one. The
+    buffer is written out once it holds more than MAX_SIZE characters, `interval`
+    seconds after the first write into it, or when flush() is called.
+
+    The timed write-out happens on a timer thread, so that the results aren't held
+    back while a slow test runs.
+    """
+
+    MAX_SIZE = 8192
+
+    def __init__(self, file, interval):
+        self._file = file
+        self._out = _duplicate_output(file)
+        self._duplicated = self._out is not file
+        self._interval = interval
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._error = None
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def write(self, msg):
+        self._raise_error()
+        with self._lock:
+            self._buffer.append(msg)
+            self._size += len(msg)
+            if self._closed or self._size >= self.MAX_SIZE:
+                self._write_out()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        self._raise_error()
+        with self._lock:
+            self._write_out()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_out(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            msg = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            try:
+                self._out.write(msg)
+            except UnicodeEncodeError:
+                # Same fallback as TerminalWriter.write()
+                self._out.write(msg.encode("unicode-escape").decode("ascii"))
+        self._out.flush()
+
+    def close(self):
+        """
+        Write out the buffer. Anything written afterwards is written directly.
+        """
+        self.flush()
+        self._closed = True
+        if self._duplicated:
+            self._out.close()
+            self._out = self._file
+
+
+class ThreadedFile(object):
+    """
+    Wrap the terminal reporter's file to write to it from a background thread. The
+    writes are passed to the thread through a bounded queue in order, so write() only
+    blocks when QUEUE_SIZE writes are already waiting. The thread flushes the file
+    whenever it catches up, and drain() waits until everything queued is written.
+    """
+
+    QUEUE_SIZE = 1024
+    _STOP = object()
+
+    def __init__(self, file):
+        self._file = file
+        self._out = _duplicate_output(file)
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="pytest-it-output", daemon=True
+        )
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def _run(self):
+        while True:
+            msg = self._queue.get()
+            try:
+                if msg is self._STOP:
+                    return
+                try:
+                    self._out.write(msg)
+                except UnicodeEncodeError:
+                    # Same fallback as TerminalWriter.write()
+                    self._out.write(msg.encode("unicode-escape").decode("ascii"))
+                if self._queue.empty():
+                    self._out.flush()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, msg):
+        self._raise_error()
+        if self._thread is None:
+            self._out.write(msg)
+        else:
+            self._queue.put(msg)
+
+    def flush(self):
+        # The thread flushes the file once it's caught up with the queue.
+        self._raise_error()
+        if self._thread is None:
+            self._out.flush()
+
+    def drain(self):
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Stop the thread. Anything written afterwards is written directly.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+        if self._out is not self._file:
+            self._out.close()
+            self._out = self._file
+        self._raise_error()
+
+
+class ProgressLine(object):
+    """
+    A status line at the bottom of the terminal. It's repainted at most every
+    INTERVAL seconds, and erased before anything else is written so that the spec
+    scrolls above it.
+    """
+
+    INTERVAL = 0.25
+
+    def __init__(self, tw):
+        self._tw = tw
+        self._shown = False
+        self._start = None
+        self._last_paint = 0.0
+        self.done = 0
+
+    def update(self, total, frames):
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self.done += 1
+        if now - self._last_paint < self.INTERVAL and self.done < total:
+            return
+        # Don't overwrite a line that something else is part way through writing.
+        if not self._shown and self._tw.width_of_current_line:
+            return
+        self._last_paint = now
+        self.erase()
+        self._tw.write(self._format(now, total, frames)[: self._tw.fullwidth - 1])
+        self._tw.flush()
+        self._shown = True
+
+    def _format(self, now, total, frames):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if rate and total > self.done:
+            remaining = int((total - self.done) / rate)
+            eta = "{:d}:{:02d}:{:02d}".format(
+                remaining // 3600, remaining // 60 % 60, remaining % 60
+            )
+        else:
+            eta = "-:--:--"
+        line = "[{}/{}] {:.1f} tests/s, ETA {}".format(self.done, total, rate, eta)
+        for kind, text in frames:
+            if kind == "describe":
+                line += " - Describe: {}".format(text)
+                break
+        return line
+
+    def erase(self):
+        if self._shown:
+            self._tw.write("\r" + " " * (self._tw.fullwidth - 1) + "\r")
+            # The writer can't tell that "\r" returned to the start of the line.
+            self._tw._current_line = ""
+            self._shown = False
+
+
+def _block_path(node):
+    return " > ".join(
+        "{}: {}".format(kind.capitalize(), text) for kind, text in node.frames
+    )
+
+
+class ItTerminalReporter(TerminalReporter):
+
+    _current_pytest_it_fspath = None
+
+    def __init__(self, config, file=None):
+        TerminalReporter.__init__(self, config, file)
+        self._prev_item = None
+        self._it_durations = config.getoption("it_durations")
+        self._it_running = {}
+        self._it_grouped = config.getoption("it_grouped")
+        self._it_only = config.getoption("it_only")
+        # The tests whose current attempt is going to be rerun, the number of
+        # attempts of each test that's been rerun so far, and the [tests, reruns,
+        # passed] of each block with a rerun test.
+        self._it_rerun = set()
+        self._it_attempts = {}
+        self._it_flaky = {}
+        self._it_stack = ItFrameStack(
+            SpecTree(),
+            show_durations=self._it_durations is not None,
+            show_passed=self._it_only is not None,
+            grouped=self._it_grouped,
+        )
+        # With --it-grouped, the block children and the (module, line) of each result,
+        # in the order they were first seen.
+        self._it_entries = {}
+        self._showfs_path = False
+        # When running under pytest-xdist, results are held back and printed in
+        # collection order, so that reports from different workers don't break up
+        # the Describe/Context blocks.
+        self._it_order = CollectionOrder()
+        interval = config.getoption("it_flush_interval")
+        if config.getoption("it_output_thread"):
+            self._tw._file = ThreadedFile(self._tw._file)
+        elif interval and interval > 0:
+            self._tw._file = BufferedFile(self._tw._file, interval)
+        self._it_progress = None
+        show_progress = config.getoption("it_progress") and self.isatty
+        if show_progress and config.getoption("capture") != "no":
+            self._it_progress = ProgressLine(self._tw)
+
+    def _register_stats(self, report):
+        res = self.config.hook.pytest_report_teststatus(
+            report=report, config=self.config
+        )
+        self.stats.setdefault(res[0], []).append(report)
+        self._tests_ran = True
+
+    def pytest_runtest_logreport(self, report):
+        self._register_stats(report)
+        item = ItItem.from_report(report, self.config)
+        if self._it_durations is not None:
+            self._add_duration(item, report)
+        if report.outcome == "rerun":
+            # Only the final attempt is shown, with the number of attempts.
+            self._it_rerun.add(report.nodeid)
+        if report.when == "teardown" and self._end_attempt(report.nodeid):
+            if self._it_progress is not None:
+                self._it_progress.update(self._session.testscollected, item.spec.frames)
+        if report.outcome == "rerun":
+            return
+        if report.when != "call" and not report.skipped:
+            return
+        attempts = self._it_attempts.get(report.nodeid, 1)
+        if attempts > 1:
+            item.attempts = attempts
+            self._add_flaky(item, report)
+        if self._it_order.active:
+            self._it_order.hold(report.nodeid, self._show_result, item, report.outcome)
+        else:
+            self._show_result(item, report.outcome)
+
+    def _show_result(self, item, outcome):
+        if not self._it_grouped:
+            self._print_result(item, outcome)
+        elif not self._is_hidden(item, outcome):
+            self._group_result(item, outcome)
+
+    def _erase_progress(self):
+        if self._it_progress is not None:
+            self._it_progress.erase()
+
+    def _is_hidden(self, item, outcome):
+        """
+        Return True if --it-only hides the result, counting it if it passed. The
+        blocks are only opened once a result inside them is displayed.
+        """
+        if self._it_only is None or outcome in self._it_only:
+            return False
+        if outcome == "passed":
+            self._it_stack.tree.node_for_spec(item.spec).add_hidden_passed()
+        return True
+
+    def _add_duration(self, item, report):
+        # The test's duration is only added to its block once the teardown is done,
+        # by which point its result has been printed and the block opened. Results
+        # that are held back for ordering keep their duration until they're printed.
+        duration = self._it_running.pop(report.nodeid, 0.0) + report.duration
+        if report.when != "teardown":
+            self._it_running[report.nodeid] = duration
+        else:
+            node = self._it_stack.tree.node_for_spec(item.spec)
+            if self._it_order.active and not self._it_grouped:
+                self._it_order.hold(report.nodeid, node.add_duration, duration)
+            else:
+                node.add_duration(duration)
+
+    def _end_attempt(self, nodeid):
+        """
+        Called at the teardown of each attempt of a test. Returns True if it was the
+        test's final attempt, or False if the test is going to be rerun.
+        """
+        if nodeid in self._it_rerun:
+            self._it_rerun.discard(nodeid)
+            self._it_attempts[nodeid] = self._it_attempts.get(nodeid, 1) + 1
+            return False
+        self._it_attempts.pop(nodeid, None)
+        return True
+
+    def _add_flaky(self, item, report):
+        node = self._it_stack.tree.node_for_spec(item.spec)
+        counts = self._it_flaky.get(node)
+        if counts is None:
+            counts = self._it_flaky[node] = [0, 0, 0]
+        counts[0] += 1
+        counts[1] += item.attempts - 1
+        if report.passed:
+            counts[2] += 1
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        # A test that's being rerun isn't finished until its final attempt.
+        if self._it_order.active and nodeid not in self._it_attempts:
+            self._it_order.finish(nodeid)
+            self.print_pending_results(finished_only=True)
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_node_collection_finished(self, node, ids):
+        """
+        Every pytest-xdist worker collects the same tests, so the first one to finish
+        collecting gives the order in which to print the results.
+        """
+        self._it_order.set_nodeids(ids)
+
+    def _group_result(self, item, outcome):
+        node = self._it_stack.tree.node_for_spec(item.spec)
+        entries = self._it_entries.get(node)
+        if entries is None:
+            entries = self._it_entries[node] = []
+            # Add the block to the enclosing blocks that haven't been seen yet.
+            child = node
+            while child.parent is not None:
+                siblings = self._it_entries.get(child.parent)
+                if siblings is not None:
+                    siblings.append(child)
+                    break
+                self._it_entries[child.parent] = [child]
+                child = child.parent
+        entries.append((item.module, item.formatted_line(node, outcome)))
+
+    def print_grouped_results(self):
+        """
+        Print the results held back by --it-grouped, one block at a time. This walks
+        the tree with an explicit stack so that deep nesting doesn't recurse.
+        """
+        root = self._it_stack.tree.root
+        todo = [(root, iter(self._it_entries.pop(root, ())))]
+        while todo:
+            node, entries = todo[-1]
+            entry = next(entries, None)
+            if entry is None:
+                todo.pop()
+            elif isinstance(entry, SpecNode):
+                todo.append((entry, iter(self._it_entries.pop(entry))))
+            else:
+                module, line = entry
+                self._it_stack.reconcile(node, module, self._tw)
+                self._tw.line(line)
+
+    def finish_spec(self):
+        """
+        Print anything that's been held back and close the open blocks.
+        """
+        self._erase_progress()
+        self.print_pending_results()
+        if self._it_grouped:
+            self.print_grouped_results()
+        self._it_stack.close_all(self._tw)
+        self._drain_output()
+
+    def _drain_output(self):
+        """
+        Wait until everything written so far is on the terminal, before something
+        else writes to it directly.
+        """
+        self._tw.flush()
+        drain = getattr(self._tw._file, "drain", None)
+        if drain is not None:
+            drain()
+
+    def summary_it_durations(self):
+        # NOTE: this is modelled on the --durations summary in _pytest.runner
+        if self._it_durations is None:
+            return
+        durations_min = 0.005 if self.config.get_verbosity() < 2 else 0.0
+        blocks = [n for n in self._it_stack.tree.nodes() if n.depth]
+        if not blocks:
+            return
+        blocks.sort(key=lambda n: n.duration, reverse=True)
+        if not self._it_durations:
+            self.write_sep("=", "slowest spec blocks")
+        else:
+            self.write_sep("=", "slowest {} spec blocks".format(self._it_durations))
+            blocks = blocks[: self._it_durations]
+        for i, node in enumerate(blocks):
+            if node.duration < durations_min:
+                self.write_line("")
+                self.write_line(
+                    "({} blocks < {:g}s hidden.  Use -vv to show these blocks.)".format(
+                        len(blocks) - i, durations_min
+                    )
+                )
+                break
+            self.write_line("{:02.2f}s {}".format(node.duration, _block_path(node)))
+
+    def summary_it_flaky(self):
+        """
+        List the blocks whose tests had to be rerun, the most reruns first.
+        """
+        blocks = [n for n in self._it_flaky if n.depth]
+        if not blocks:
+            return
+        blocks.sort(key=lambda n: self._it_flaky[n][1], reverse=True)
+        self.write_sep("=", "flakiest spec blocks")
+        for node in blocks:
+            tests, reruns, passed = self._it_flaky[node]
+            self.write_line(
+                "{} reruns in {} tests ({} passed) {}".format(
+                    reruns, tests, passed, _block_path(node)
+                )
+            )
+
+    def print_pending_results(self, finished_only=False):
+        """
+        Print the results that are being held back for ordering. If finished_only is
+        True, stop at the first test in the collection order that hasn't finished yet.
+        """
+        self._it_order.release(finished_only)
+
+    def _print_result(self, item, outcome):
+        if self._is_hidden(item, outcome):
+            return
+        self._erase_progress()
+        if self._prev_item is not None and item.module != self._prev_item.module:
+            # End of the previous module.
+            self._tw.flush()
+        if self._it_order.active:
+            # pytest_runtest_logstart is called in execution order, so print the path
+            # alongside the result instead.
+            self._write_fspath(item.nodeid)
+        item.reconcile_and_print(self._it_stack, self._tw, outcome)
+        self._prev_item = item
+
+    # This is probably the best function to override. _print_collecteditems() is also a candidate, but
+    # I think it's more liable to change because it's a private method.
+    def pytest_collection_finish(self, session):
+        if self.config.getoption("collectonly"):
+            cache = self.config.pluginmanager.getplugin("it-collect-cache")
+            if cache is not None:
+                it_items = cache.it_items(session.items)
+                self._numcollected += cache.cached_count
+            else:
+                it_items = (ItItem.from_item(item) for item in session.items)
+            stack = ItFrameStack(SpecTree())
+            for it_item in it_items:
+                it_item.reconcile_and_print(stack, self._tw, outcome=None)
+            if cache is not None:
+                cache.save(session.items)
+
+        # NOTE: this logic is copied from TerminalReporter.pytest_collection_finish
+        lines = self.config.hook.pytest_report_collectionfinish(
+            config=self.config, start_path=self.startpath, items=session.items
+        )
+        self._write_report_lines_from_hooks(lines)
+        if self.config.getoption("collectonly"):
+            if self.stats.get("failed"):
+                self._tw.sep("!", "collection failures")
+                for rep in self.stats.get("failed"):
+                    rep.toterminal(self._tw)
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        """
+        Disable the normal running test output
+        """
+        if not self._it_order.active and not self._it_grouped:
+            self._write_fspath(nodeid)
+        if self.config.getoption("capture") == "no":
+            # Keep the spec in step with anything the test prints.
+            self._drain_output()
+
+    def pytest_enter_pdb(self, config, pdb):
+        self._drain_output()
+
+    def pytest_unconfigure(self):
+        TerminalReporter.pytest_unconfigure(self)
+        self._drain_output()
+        if isinstance(self._tw._file, (BufferedFile, ThreadedFile)):
+            self._tw._file.close()
+
+    def _write_fspath(self, nodeid):
+        self._erase_progress()
         if self.showfspath:
             fsid = nodeid.split("::")[0]
             # below logic is very similar to self.write_fspath_result(). Ideally we would
@@ -276,6 +2601,11 @@ class ItTerminalReporter(TerminalReporter):
             # path.
             fspath = self.config.rootpath / fsid
             if fspath != self.currentfspath:
+                # Print the summary lines of the previous module's blocks before its
+                # path, rather than after it.
+                stack = self._it_stack
+                if stack.show_durations or stack.show_passed:
+                    stack.close_all(self._tw)
                 if self.currentfspath is not None and self._show_progress_info:
                     self._write_progress_information_filling_space()
                 self.currentfspath = fspath
@@ -55,6 +55,19 @@ class TestSanity(object):
         result = testdir.runpytest("--it", "--it-no-color")
         assert result.ret == 0  # 0 exit code for the test suite
 
+    @m.context("When pytest is called without the --it flag")
+    @m.it("Does not register the per-test hooks")
+    def test_without_flag_hooks_are_not_registered(self, testdir):
+        config = testdir.parseconfigure()
+        assert config.pluginmanager.getplugin("it-plugin") is None
+        config = testdir.parseconfigure("--it")
+        assert config.pluginmanager.getplugin("it-plugin") is not None
+
+        testdir.makepyfile(self.BASIC_PYTEST_TEST_CODE)
+        reprec = testdir.inline_run()
+        for report in reprec.getreports("pytest_runtest_logreport"):
+            assert not hasattr(report, "_it_spec")
+
     @m.context("When pytest is called without the --it flag")
     @m.it("Does not cause pytest to error")
     def test_without_flag(self, testdir):
@@ -339,6 +352,24 @@ class TestTestFormat(object):
         result = testdir.runpytest("--it-no-color")
         result.stdout.fnmatch_lines(["*- ✓ It: Does something*"])
 
+    @m.context("When @pytest.mark.it is not used")
+    @m.context("but the test name starts with 'test_it_'")
+    @m.it("Displays the parametrisation after the prettified name")
+    def test_populates_the_it_marker_for_parametrised_tests(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("param", ["a", "b"])
+            def test_it_does_something(param):
+                assert True
+        """
+        )
+        result = testdir.runpytest("--it-no-color")
+        result.stdout.fnmatch_lines(
+            ["*- ✓ It: Does something - [[]a]", "*- ✓ It: Does something - [[]b]"]
+        )
+
     @m.context("When multiple @pytest.mark.it markers are used")
     @m.it("Uses the lowest decorator for the 'It : ' value")
     def test_uses_the_closest_it_decorator_if_there_are_many(self, testdir):
@@ -356,3 +387,1262 @@ class TestTestFormat(object):
         )
         result = testdir.runpytest("--it-no-color")
         result.stdout.fnmatch_lines(["*- ✓ It: Does something A*"])
+
+
+@m.describe("The spec resolved at collection time")
+class TestSpec(object):
+    @m.it("Caches the Describe/Context frames and the It title on each item")
+    def test_spec_is_cached_on_item(self, testdir):
+        from pytest_it.plugin import SPEC_KEY
+
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            class TestFoo(object):
+
+                @pytest.mark.context("When something")
+                @pytest.mark.it("Does something")
+                def test_foo(self):
+                    assert True
+
+                def test_it_does_something_else(self):
+                    assert True
+        """
+        )
+        items, _ = testdir.inline_genitems("--it")
+        spec = items[0].stash[SPEC_KEY]
+        assert spec.frames == (("describe", "A foo"), ("context", "When something"))
+        assert spec.title == "Does something"
+        spec = items[1].stash[SPEC_KEY]
+        assert spec.frames == (("describe", "A foo"),)
+        assert spec.title == "Does something else"
+
+    @m.it("Interns the frames so the tests in a block share them")
+    def test_frames_are_interned(self, testdir):
+        from pytest_it.plugin import FRAME_TABLE_KEY, SPEC_KEY
+
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            class TestFoo(object):
+
+                @pytest.mark.context("When something")
+                @pytest.mark.parametrize("param", range(2))
+                def test_foo(self, param):
+                    assert True
+
+                def test_bar(self):
+                    assert True
+        """
+        )
+        items, _ = testdir.inline_genitems("--it")
+        first, second, third = [item.stash[SPEC_KEY] for item in items]
+        assert first.frames is second.frames
+        assert first.frame_id == second.frame_id
+        table = items[0].config.stash[FRAME_TABLE_KEY]
+        assert table.frames[first.frame_id] is first.frames
+        assert table.frames[table.parents[first.frame_id]] is third.frames
+        assert first.frames[0] is third.frames[0]
+
+    @m.it("Attaches the spec to each report instead of the pytest Item")
+    def test_report_does_not_keep_item(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", ["a"])
+            def test_foo(param):
+                assert True
+        """
+        )
+        reprec = testdir.inline_run("--it")
+        reports = reprec.getreports("pytest_runtest_logreport")
+        assert len(reports) == 3
+        for report in reports:
+            assert not hasattr(report, "_item")
+            assert report._it_spec.frames == (("describe", "A foo"),)
+            assert report._it_spec.module == "test_report_does_not_keep_item.py"
+            assert report._it_spec.param == "a"
+
+    @m.it("Only opens the blocks that differ from the previous test")
+    def test_frame_stack_opens_changed_blocks(self):
+        from pytest_it.plugin import ItFrameStack, SpecTree
+
+        tree = SpecTree()
+        stack = ItFrameStack(tree)
+        a = ("describe", "A foo")
+        b = ("context", "When something")
+        c = ("context", "And another thing")
+        _, opened = stack.move_to(tree.node_for((a, b, c)))
+        assert [n.header for n in opened] == [
+            "- Describe: A foo...",
+            "  - Context: When something...",
+            "    - ...and another thing...",
+        ]
+        assert stack.move_to(tree.node_for((a, b, c))) == ([], [])
+        closed, opened = stack.move_to(tree.node_for((a,)))
+        assert closed == [tree.node_for((a, b, c)), tree.node_for((a, b))]
+        assert opened == []
+        closed, opened = stack.move_to(tree.node_for((a, c)))
+        assert closed == []
+        assert [n.header for n in opened] == ["  - Context: And another thing..."]
+        assert opened[0] is tree.node_for((a, c))
+
+    @m.it("Exposes the spec of the collected tests through the SpecIndex")
+    @m.parametrize("args", [[], ["--it"]])
+    def test_spec_index(self, testdir, args):
+        testdir.makeconftest(
+            """
+            import pytest_it
+
+            def pytest_collection_finish(session):
+                index = pytest_it.get_spec_index(session)
+                foo = (("describe", "A foo"),)
+                print("nodeids:", index.nodeids(foo))
+                print("blocks:", list(index.blocks()))
+                print("frames:", index.frames("test_spec_index.py::test_baz"))
+        """
+        )
+        testdir.makepyfile(
+            """
+            import pytest
+
+            pytestmark = pytest.mark.describe("A foo")
+
+            @pytest.mark.context("When something")
+            def test_bar():
+                pass
+
+            @pytest.mark.describe("A baz")
+            def test_baz():
+                pass
+
+            def test_qux():
+                pass
+        """
+        )
+        result = testdir.runpytest("-s", *args)
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(
+            [
+                "nodeids: ['test_spec_index.py::test_bar', "
+                "'test_spec_index.py::test_baz', 'test_spec_index.py::test_qux']",
+                "blocks: [(('describe', 'A foo'),), "
+                "(('describe', 'A foo'), ('context', 'When something')), "
+                "(('describe', 'A foo'), ('describe', 'A baz'))]",
+                "frames: (('describe', 'A foo'), ('describe', 'A baz'))",
+            ]
+        )
+
+
+@m.describe("The pytest-xdist integration")
+class TestXdist(object):
+    @m.it("Prints the results in collection order without splitting the blocks")
+    def test_results_are_grouped_in_collection_order(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(10))
+            @pytest.mark.it("Does something")
+            def test_foo(param):
+                assert True
+
+            @pytest.mark.describe("A bar")
+            @pytest.mark.parametrize("param", range(10))
+            @pytest.mark.it("Does something else")
+            def test_bar(param):
+                assert True
+        """
+        )
+        result = testdir.runpytest("--it", "--it-no-color", "-n", "2")
+        assert result.ret == 0
+        lines = [line.strip() for line in result.stdout.lines]
+        assert lines.count("- Describe: A foo...") == 1
+        assert lines.count("- Describe: A bar...") == 1
+        results = [line for line in lines if line.startswith("- ✓")]
+        expected = ["- ✓ It: Does something - [{}]".format(i) for i in range(10)]
+        expected += ["- ✓ It: Does something else - [{}]".format(i) for i in range(10)]
+        assert results == expected
+
+
+@m.describe("The buffered terminal output")
+class TestBufferedOutput(object):
+    @m.it("Writes all of the buffered output by the end of the session")
+    @m.parametrize("interval", ["0", "60"])
+    def test_all_output_is_written(self, testdir, interval):
+        testdir.makepyfile(
+            test_a="""
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(100))
+            @pytest.mark.it("Does something")
+            def test_foo(param):
+                assert True
+        """,
+            test_b="""
+            import pytest
+
+            @pytest.mark.describe("A bar")
+            @pytest.mark.it("Does something else")
+            def test_bar():
+                assert True
+        """,
+        )
+        result = testdir.runpytest("--it-no-color", "--it-flush-interval", interval)
+        result.stdout.fnmatch_lines(
+            [
+                "*- Describe: A foo*",
+                "*- ✓ It: Does something - [[]99]*",
+                "*- Describe: A bar*",
+                "*- ✓ It: Does something else*",
+                "*101 passed*",
+            ]
+        )
+
+    @m.it("Writes the buffer out after the interval without waiting for another write")
+    def test_written_after_interval(self):
+        import io
+        import time
+
+        from pytest_it.plugin import BufferedFile
+
+        out = io.StringIO()
+        buffered = BufferedFile(out, 0.05)
+        buffered.write("- ✓ It: Does something\n")
+        assert out.getvalue() == ""
+        deadline = time.monotonic() + 5
+        while not out.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert out.getvalue() == "- ✓ It: Does something\n"
+        buffered.close()
+
+
+@m.describe("The --it-output-thread option")
+class TestOutputThread(object):
+    @m.it("Writes the same output as the main thread, without capturing it")
+    def test_same_output(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(50))
+            @pytest.mark.it("Does something")
+            def test_foo(param):
+                print("captured", param)
+                assert param != 25
+        """
+        )
+        args = ("--it-no-color", "-p", "no:randomly", "-rP")
+        expected = testdir.runpytest_subprocess(*args).stdout.lines
+        result = testdir.runpytest_subprocess("--it-output-thread", *args)
+        assert result.ret == 1
+        assert [line for line in result.stdout.lines if " in " not in line] == [
+            line for line in expected if " in " not in line
+        ]
+        assert "captured 25" in result.stdout.str()
+        assert "  - ✓ It: Does something - [49]" in result.stdout.lines
+
+
+@m.describe("The --it-jsonl option")
+class TestJsonl(object):
+    CODE = """
+        import pytest
+
+        @pytest.mark.describe("A foo")
+        @pytest.mark.context("When something")
+        @pytest.mark.it("Does something")
+        def test_foo():
+            assert True
+
+        @pytest.fixture
+        def broken():
+            raise ValueError
+
+        def test_bar(broken):
+            pass
+
+        def test_skipped():
+            pytest.skip()
+    """
+
+    @m.it("Writes one record per test with its spec path and outcome")
+    @m.parametrize("args", [[], ["--it"]])
+    def test_records(self, testdir, args):
+        import json
+
+        testdir.makepyfile(self.CODE)
+        result = testdir.runpytest("--it-jsonl", "out/spec.jsonl", *args)
+        result.stdout.fnmatch_lines(["*generated it-jsonl file*"])
+        with open(str(testdir.tmpdir.join("out", "spec.jsonl"))) as f:
+            records = [json.loads(line) for line in f]
+        assert [(r["nodeid"], r["outcome"]) for r in records] == [
+            ("test_records.py::test_foo", "passed"),
+            ("test_records.py::test_bar", "error"),
+            ("test_records.py::test_skipped", "skipped"),
+        ]
+        assert records[0]["frames"] == [
+            ["describe", "A foo"],
+            ["context", "When something"],
+        ]
+        assert records[0]["title"] == "Does something"
+        assert records[0]["duration"] >= 0
+
+
+@m.describe("The --it-export option")
+class TestExport(object):
+    CODE = """
+        import pytest
+
+        pytestmark = pytest.mark.describe("A foo")
+
+        @pytest.mark.context("When something")
+        @pytest.mark.it("Does <something>")
+        def test_foo():
+            assert True
+
+        def test_bar():
+            assert False
+    """
+
+    @m.it("Writes the spec as an org-mode, Markdown and HTML document")
+    def test_formats(self, testdir):
+        testdir.makepyfile(self.CODE)
+        result = testdir.runpytest(
+            "--it-export=org:out/spec.org",
+            "--it-export=markdown:out/spec.md",
+            "--it-export=html:out/spec.html",
+        )
+        result.stdout.fnmatch_lines(["*generated it-export org file*"])
+        out = testdir.tmpdir.join("out")
+        assert out.join("spec.org").read_text("utf-8").splitlines() == [
+            "* Describe: A foo",
+            "** Context: When something",
+            "- ✓ It: Does <something>",
+            "* Describe: A foo",
+            "- F test_bar",
+        ]
+        assert out.join("spec.md").read_text("utf-8").splitlines() == [
+            "# Describe: A foo",
+            "",
+            "## Context: When something",
+            "",
+            "- ✓ It: Does \\<something\\>",
+            "",
+            "# Describe: A foo",
+            "",
+            "- F test\\_bar",
+        ]
+        document = out.join("spec.html").read_text("utf-8")
+        assert '<p class="passed">✓ It: Does &lt;something&gt;</p>' in document
+        assert document.rstrip().endswith("</section>\n</body>\n</html>")
+
+    @m.it("Rejects unknown formats")
+    def test_invalid_format(self, testdir):
+        testdir.makepyfile(self.CODE)
+        result = testdir.runpytest("--it-export=pdf:out/spec.pdf")
+        assert result.ret != 0
+        result.stderr.fnmatch_lines(["*expected FORMAT:PATH*"])
+
+    @m.it("Writes the results in collection order with pytest-xdist")
+    def test_xdist_order(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import time
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(3))
+            def test_foo(param):
+                time.sleep(0.3 if param == 0 else 0)
+
+            @pytest.mark.describe("A bar")
+            @pytest.mark.parametrize("param", range(3))
+            def test_bar(param):
+                pass
+        """
+        )
+        result = testdir.runpytest("--it-export=org:spec.org", "-n", "2")
+        assert result.ret == 0
+        assert testdir.tmpdir.join("spec.org").read_text("utf-8").splitlines() == [
+            "* Describe: A foo",
+            "- ✓ test_foo[0] - [0]",
+            "- ✓ test_foo[1] - [1]",
+            "- ✓ test_foo[2] - [2]",
+            "* Describe: A bar",
+            "- ✓ test_bar[0] - [0]",
+            "- ✓ test_bar[1] - [1]",
+            "- ✓ test_bar[2] - [2]",
+        ]
+
+
+@m.describe("The --it-select option")
+class TestSelect(object):
+    CODE = """
+        import pytest
+
+        pytestmark = pytest.mark.describe("The billing engine")
+
+        @pytest.mark.context("When the card is declined")
+        @pytest.mark.it("Retries the payment")
+        def test_retry():
+            pass
+
+        @pytest.mark.context("When the card is declined")
+        @pytest.mark.context("and the customer is new")
+        def test_new_customer():
+            pass
+
+        @pytest.mark.context("When the card is accepted")
+        def test_accepted():
+            pass
+    """
+
+    @m.it("Deselects the tests outside the matching blocks")
+    @m.parametrize(
+        "pattern,selected",
+        [
+            (
+                "Describe: The billing engine / Context: when the card is declined",
+                ["test_retry", "test_new_customer"],
+            ),
+            ("the billing engine/*accepted", ["test_accepted"]),
+            ("the billing engine/*/it: retries*", ["test_retry"]),
+            ("Context: the billing engine", []),
+        ],
+    )
+    def test_select(self, testdir, pattern, selected):
+        testdir.makepyfile(self.CODE)
+        reprec = testdir.inline_run("--it-select", pattern)
+        passed, _, _ = reprec.listoutcomes()
+        assert [r.nodeid.split("::")[-1] for r in passed] == selected
+        deselected = reprec.getcall("pytest_deselected").items
+        assert len(deselected) == 3 - len(selected)
+
+    @m.it("Rejects an 'It:' part that isn't at the end of the path")
+    def test_invalid_pattern(self, testdir):
+        testdir.makepyfile(self.CODE)
+        result = testdir.runpytest("--it-select", "It: retries/foo")
+        assert result.ret != 0
+        result.stderr.fnmatch_lines(["*can only be the last part*"])
+
+
+@m.describe("The --it-dist-group option")
+class TestDistGroup(object):
+    @m.it("Groups the tests by their outermost Describe/Context blocks")
+    def test_xdist_group_marker(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            pytestmark = pytest.mark.describe("A foo")
+
+            @pytest.mark.context("When something")
+            def test_bar():
+                pass
+
+            @pytest.mark.context("When something else")
+            def test_baz():
+                pass
+        """
+        )
+        testdir.makepyfile(test_other="def test_qux(): pass")
+        items, _ = testdir.inline_genitems("--it-dist-group=2")
+        groups = {}
+        for item in items:
+            marker = item.get_closest_marker("xdist_group")
+            groups[item.name] = marker.args[0] if marker else None
+        assert groups == {
+            "test_bar": "A foo/When something",
+            "test_baz": "A foo/When something else",
+            "test_qux": None,
+        }
+
+    @m.it("Shows the markers added by the other plugins' hooks")
+    def test_markers_added_later(self, testdir):
+        testdir.makeconftest(
+            """
+            import pytest
+
+            def pytest_collection_modifyitems(items):
+                for item in items:
+                    item.add_marker(pytest.mark.describe("Added by conftest"))
+        """
+        )
+        testdir.makepyfile("def test_foo(): pass")
+        result = testdir.runpytest("--it", "--it-no-color", "--it-dist-group=1")
+        result.stdout.fnmatch_lines(
+            ["- Describe: Added by conftest...", "  - ✓ test_foo"]
+        )
+
+    @m.it("Runs each group on one pytest-xdist worker")
+    def test_loadgroup(self, testdir):
+        import re
+
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(6))
+            def test_foo(param, worker_id):
+                print("worker:", worker_id)
+        """
+        )
+        result = testdir.runpytest(
+            "-n", "2", "--dist", "loadgroup", "--it-dist-group=1", "-rP"
+        )
+        assert result.ret == 0
+        workers = set(re.findall(r"worker: (gw\d)", result.stdout.str()))
+        assert len(workers) == 1
+
+    @m.it("Doesn't show pytest-xdist's group suffix in the nodeids")
+    def test_loadgroup_nodeids(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            def test_plain():
+                pass
+        """
+        )
+        testdir.runpytest("--it", "--it-snapshot", "snap")
+        result = testdir.runpytest(
+            "--it",
+            "--it-no-color",
+            "-n",
+            "2",
+            "--dist",
+            "loadgroup",
+            "--it-dist-group=1",
+            "--it-diff",
+            "snap",
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(
+            ["  - ✓ test_plain", "*diff against snap*", "no changes"]
+        )
+        assert "test_plain@" not in result.stdout.str()
+
+
+@m.describe("The --it-shard option")
+class TestShard(object):
+    CODE = """
+        import pytest
+
+        @pytest.mark.describe("A foo")
+        @pytest.mark.parametrize("param", range(4))
+        def test_foo(param):
+            pass
+
+        @pytest.mark.describe("A bar")
+        @pytest.mark.context("When something")
+        @pytest.mark.parametrize("param", range(2))
+        def test_bar(param):
+            pass
+
+        @pytest.mark.describe("A bar")
+        def test_baz():
+            pass
+
+        def test_qux():
+            pass
+    """
+
+    def shard(self, testdir, shard):
+        reprec = testdir.inline_run("--it-shard", shard)
+        passed, _, _ = reprec.listoutcomes()
+        return [r.nodeid.split("::")[-1] for r in passed]
+
+    @m.it("Splits the top-level blocks by test count when there's no history")
+    def test_split_by_count(self, testdir):
+        testdir.makepyfile(self.CODE)
+        assert self.shard(testdir, "1/2") == ["test_foo[{}]".format(i) for i in range(4)]
+        assert self.shard(testdir, "2/2") == [
+            "test_bar[0]",
+            "test_bar[1]",
+            "test_baz",
+            "test_qux",
+        ]
+
+    @m.it("Records the duration of each block and splits by predicted duration")
+    def test_split_by_history(self, testdir):
+        import json
+
+        testdir.makepyfile(self.CODE)
+        testdir.runpytest("--it")
+        path = testdir.tmpdir.join(".pytest_cache", "v", "pytest_it", "durations")
+        history = json.loads(path.read())
+        assert set(history) == {
+            '[["describe", "A foo"]]',
+            '[["describe", "A bar"]]',
+            '[["describe", "A bar"], ["context", "When something"]]',
+            '[["module", "test_split_by_history.py"]]',
+        }
+        history['[["describe", "A bar"]]'] = 10.0
+        path.write(json.dumps(history))
+        assert self.shard(testdir, "1/2") == ["test_bar[0]", "test_bar[1]", "test_baz"]
+        assert len(self.shard(testdir, "2/2")) == 5
+
+    @m.it("Runs every test exactly once across the shards on one cache")
+    @m.parametrize("history", [False, True])
+    def test_shards_cover_suite(self, testdir, history):
+        block = '@pytest.mark.describe("B{0}")\ndef test_b{0}():\n    pass\n'
+        testdir.makepyfile(
+            "import pytest\n" + "".join(block.format(i) for i in range(6))
+        )
+        if history:
+            testdir.runpytest("--it")
+        expected = ["test_b{}".format(i) for i in range(6)]
+        for n in (2, 3, 4):
+            ran = []
+            for k in range(1, n + 1):
+                ran.extend(self.shard(testdir, "{}/{}".format(k, n)))
+            assert sorted(ran) == expected
+
+
+@m.describe("The --it-profile option")
+class TestProfile(object):
+    @m.it("Shows the time spent in each phase and writes it as JSON")
+    def test_profile(self, testdir):
+        import json
+
+        from pytest_it.plugin import ItItem, ItSpec
+
+        from_item = ItSpec.__dict__["from_item"]
+        reconcile_and_print = ItItem.reconcile_and_print
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(3))
+            def test_foo(param):
+                pass
+        """
+        )
+        result = testdir.runpytest("--it", "--it-profile-json=out/profile.json")
+        result.stdout.fnmatch_lines(
+            [
+                "*pytest-it profile*",
+                "markers * 3 *",
+                "collection * 1 *",
+                "reconcile_and_print * 3 *",
+                "_register_stats * 9 *",
+                "total *ms (*)",
+                "*generated it-profile file*",
+            ]
+        )
+        with open(str(testdir.tmpdir.join("out", "profile.json"))) as f:
+            profile = json.load(f)
+        assert profile["phases"]["markers"]["calls"] == 3
+        assert profile["session"] > 0
+        # The timed wrappers are removed at the end of the run.
+        assert ItSpec.__dict__["from_item"] is from_item
+        assert ItItem.reconcile_and_print is reconcile_and_print
+
+    @m.it("Doesn't subtract the time of another thread's writes from a phase")
+    def test_threads(self):
+        import threading
+        import time
+
+        from pytest_it.plugin import ItProfile
+
+        profile = ItProfile()
+        write = profile.timed("terminal writes", lambda: time.sleep(0.1))
+
+        def collect():
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join()
+
+        profile.timed("collection", collect)()
+        assert profile.phases["collection"][0] >= 0.09
+        assert profile.phases["terminal writes"][0] >= 0.09
+
+
+@m.describe("The --it-diff option")
+class TestDiff(object):
+    @m.it("Shows the tests that were added, removed or changed outcome")
+    def test_diff(self, testdir):
+        code = """
+            import pytest
+
+            pytestmark = pytest.mark.describe("A foo")
+
+            @pytest.mark.it("Does something")
+            def test_foo():
+                assert {}
+
+            def test_{}():
+                pass
+        """
+        testdir.makepyfile(test_one=code.format("True", "bar"))
+        result = testdir.runpytest("--it-snapshot=out/snapshot.json")
+        result.stdout.fnmatch_lines(["*generated it-snapshot file*"])
+        testdir.makepyfile(test_one=code.format("False", "baz"))
+        result = testdir.runpytest("--it-diff=out/snapshot.json")
+        result.stdout.fnmatch_lines(
+            [
+                "*pytest-it diff against out/snapshot.json*",
+                "~ test_one.py / Describe: A foo / It: Does something (passed -> failed)",
+                "- test_one.py / Describe: A foo / test_bar (passed)",
+                "+ test_one.py / Describe: A foo / test_baz (passed)",
+            ]
+        )
+        result = testdir.runpytest("--it-diff=last")
+        result.stdout.fnmatch_lines(["*pytest-it diff against last*", "no changes"])
+
+    @m.it("Merges two snapshots sorted by hash")
+    def test_diff_snapshots(self):
+        from pytest_it.plugin import diff_snapshots
+
+        old = [("1", "a", "passed"), ("2", "b", "passed"), ("4", "d", "passed")]
+        new = [("2", "b", "failed"), ("3", "c", "passed"), ("4", "d", "passed")]
+        assert list(diff_snapshots(old, new)) == [
+            ("a", "-", "passed", None),
+            ("b", "~", "passed", "failed"),
+            ("c", "+", None, "passed"),
+        ]
+
+
+@m.describe("The --it-coverage-contexts option")
+class TestCoverageContexts(object):
+    LIB = """
+        def add(a, b):
+            return a + b
+
+        def sub(a, b):
+            if a > b:
+                return a - b
+            return -(b - a)
+    """
+    CODE = """
+        import pytest
+        from lib import add, sub
+
+        @pytest.mark.describe("Add")
+        def test_add():
+            assert add(1, 2) == 3
+
+        @pytest.mark.describe("Sub")
+        @pytest.mark.parametrize("a", [1, 3])
+        def test_sub(a):
+            assert sub(a, 2) == a - 2
+    """
+    EXPECTED = [
+        "*pytest-it coverage by block*",
+        "*lines*unique*block",
+        "*4*4*Describe: Sub",
+        "*2*2*Describe: Add",
+    ]
+
+    @m.it("Records a coverage.py context for each block")
+    def test_contexts(self, testdir):
+        import sys
+
+        pytest.importorskip("coverage")
+        testdir.makepyfile(lib=self.LIB)
+        testdir.makepyfile(self.CODE)
+        result = testdir.run(
+            sys.executable,
+            "-m",
+            "coverage",
+            "run",
+            "-m",
+            "pytest",
+            "-p",
+            "no:cacheprovider",
+            "--it-coverage-contexts",
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(self.EXPECTED)
+
+    @m.it("Works with pytest-cov")
+    def test_pytest_cov(self, testdir):
+        pytest.importorskip("pytest_cov")
+        testdir.makepyfile(lib=self.LIB)
+        testdir.makepyfile(self.CODE)
+        result = testdir.runpytest_subprocess(
+            "-p", "no:cacheprovider", "--cov=.", "--it-coverage-contexts"
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(self.EXPECTED)
+        assert "INTERNALERROR" not in result.stdout.str()
+
+
+@m.describe("The --it-collect-cached option")
+class TestCollectCached(object):
+    CODE = """
+        import pytest
+
+        with open("imported.txt", "a") as f:
+            f.write("{name} ")
+
+        @pytest.mark.describe("A {name}")
+        @pytest.mark.it("Does something")
+        def test_foo():
+            assert True
+    """
+
+    @m.it("Renders unchanged modules from the cache without collecting them")
+    def test_unchanged_modules_are_not_collected(self, testdir):
+        testdir.makepyfile(
+            test_a=self.CODE.format(name="a"), test_b=self.CODE.format(name="b")
+        )
+        args = ("--it-no-color", "--collect-only", "--it-collect-cached")
+        expected = [
+            "*- Describe: A a...*",
+            "*- It: Does something*",
+            "*- Describe: A b...*",
+            "*- It: Does something*",
+            "*2 tests collected*",
+        ]
+        result = testdir.runpytest_subprocess(*args)
+        result.stdout.fnmatch_lines(expected)
+        assert testdir.tmpdir.join("imported.txt").read() == "a b "
+
+        result = testdir.runpytest_subprocess(*args)
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(expected)
+        assert testdir.tmpdir.join("imported.txt").read() == "a b "
+
+        testdir.makepyfile(test_b=self.CODE.format(name="c"))
+        result = testdir.runpytest_subprocess(*args)
+        result.stdout.fnmatch_lines(["*- Describe: A a...*", "*- Describe: A c...*"])
+        assert testdir.tmpdir.join("imported.txt").read() == "a b c "
+
+    @m.it("Only renders the cached modules under the given paths")
+    def test_only_requested_paths(self, testdir):
+        testdir.makepyfile(
+            test_a=self.CODE.format(name="a"), test_b=self.CODE.format(name="b")
+        )
+        args = ("--it-no-color", "--collect-only", "--it-collect-cached")
+        testdir.runpytest_subprocess(*args)
+        result = testdir.runpytest_subprocess(*(args + ("test_a.py",)))
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(["*- Describe: A a...*", "*1 test collected*"])
+        assert "A b" not in result.stdout.str()
+
+    @m.it("Isn't used with --it-select or --it-shard")
+    @m.parametrize("option", [["--it-select", "Describe: A a"], ["--it-shard", "1/2"]])
+    def test_selection_options(self, testdir, option):
+        testdir.makepyfile(
+            test_a=self.CODE.format(name="a"), test_b=self.CODE.format(name="b")
+        )
+        args = ("--it-no-color", "--collect-only", "--it-collect-cached")
+        testdir.runpytest_subprocess(*args)
+        result = testdir.runpytest_subprocess(*(args + tuple(option)))
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(["*- Describe: A a...*", "*1/2 tests collected*"])
+        assert "A b" not in result.stdout.str()
+
+
+@m.describe("The --it-durations option")
+class TestDurations(object):
+    @m.it("Shows the total duration of each block and lists the slowest blocks")
+    def test_block_durations(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+            import pytest
+
+            @pytest.mark.describe("A slow foo")
+            @pytest.mark.context("When something")
+            def test_slow():
+                time.sleep(0.1)
+
+            @pytest.mark.describe("A fast foo")
+            def test_fast():
+                pass
+        """
+        )
+        result = testdir.runpytest("--it-no-color", "--it-durations", "2")
+        result.stdout.fnmatch_lines(
+            [
+                "- Describe: A slow foo...",
+                "  - Context: When something...",
+                "    - ✓ test_slow",
+                "    (0.1*s)",
+                "  (0.1*s)",
+                "- Describe: A fast foo...",
+                "  - ✓ test_fast",
+                "  (0.0*s)",
+                "*= slowest 2 spec blocks =*",
+                "0.1*s Describe: A slow foo",
+                "0.1*s Describe: A slow foo > Context: When something",
+            ]
+        )
+
+    @m.it("Prints the summary of the last block before the next module's path")
+    def test_summary_before_module(self, testdir):
+        testdir.makepyfile(
+            test_a="""
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            def test_foo():
+                pass
+        """,
+            test_b="""
+            def test_bar():
+                pass
+        """,
+        )
+        result = testdir.runpytest("--it-no-color", "--it-durations", "0")
+        result.stdout.fnmatch_lines(["  - ✓ test_foo", "  (0.0*s)", "* test_b.py...*"])
+        path_lines = [line for line in result.stdout.lines if line.startswith("* test_b")]
+        assert len(path_lines) == 1
+        assert "(" not in path_lines[0]
+
+    @m.it("Adds the durations in collection order with pytest-xdist")
+    def test_xdist_durations(self, testdir):
+        import re
+
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import time
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.context("When something")
+            @pytest.mark.parametrize("param", range(4))
+            def test_foo(param):
+                time.sleep(0.05)
+
+            @pytest.mark.describe("A bar")
+            @pytest.mark.parametrize("param", range(4))
+            def test_bar(param):
+                pass
+        """
+        )
+        result = testdir.runpytest("--it-no-color", "--it-durations", "0", "-n", "2")
+        output = result.stdout.str()
+        printed = re.search(r"test_foo\[3\].*\n    \((\d+\.\d+)s\)", output)
+        listed = re.search(r"(\d+\.\d+)s Describe: A foo > Context", output)
+        assert printed and listed
+        assert printed.group(1) == listed.group(1)
+
+
+@m.describe("The --it-grouped option")
+class TestGrouped(object):
+    @m.it("Displays each block once, even if its tests didn't run together")
+    def test_blocks_are_displayed_once(self, testdir):
+        code = """
+            import pytest
+
+            pytestmark = pytest.mark.describe("A foo")
+
+            @pytest.mark.context("When something")
+            @pytest.mark.it("Does something {0}")
+            def test_a():
+                assert True
+
+            @pytest.mark.context("When something else")
+            @pytest.mark.it("Does something else {0}")
+            def test_b():
+                assert True
+        """
+        testdir.makepyfile(test_one=code.format(1), test_two=code.format(2))
+        result = testdir.runpytest("--it-no-color", "--it-grouped")
+        assert result.ret == 0
+        lines = [line.strip() for line in result.stdout.lines if line.strip()]
+        start = lines.index("- Describe: A foo...")
+        assert lines[start:][:7] == [
+            "- Describe: A foo...",
+            "- Context: When something...",
+            "- ✓ It: Does something 1",
+            "- ✓ It: Does something 2",
+            "- Context: When something else...",
+            "- ✓ It: Does something else 1",
+            "- ✓ It: Does something else 2",
+        ]
+
+    @m.it("Keeps the collection order with pytest-xdist")
+    def test_xdist_order(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import time
+            import pytest
+
+            @pytest.mark.describe("One")
+            @pytest.mark.parametrize("param", range(4))
+            def test_one(param):
+                time.sleep(0.2 if param % 2 == 0 else 0)
+
+            @pytest.mark.describe("Two")
+            def test_two():
+                pass
+        """
+        )
+        result = testdir.runpytest("--it-no-color", "--it-grouped", "-n", "2")
+        assert result.ret == 0
+        lines = [line.strip() for line in result.stdout.lines if line.strip()]
+        start = lines.index("- Describe: One...")
+        assert lines[start:][:7] == [
+            "- Describe: One...",
+            "- ✓ test_one[0] - [0]",
+            "- ✓ test_one[1] - [1]",
+            "- ✓ test_one[2] - [2]",
+            "- ✓ test_one[3] - [3]",
+            "- Describe: Two...",
+            "- ✓ test_two",
+        ]
+
+
+@m.describe("The --it-progress status line")
+class TestProgressLine(object):
+    @m.it("Shows the number of tests completed and the current Describe block")
+    def test_status_line(self):
+        import io
+
+        from _pytest._io import TerminalWriter
+        from pytest_it.plugin import ProgressLine
+
+        f = io.StringIO()
+        tw = TerminalWriter(f)
+        tw.fullwidth = 80
+        progress = ProgressLine(tw)
+        progress.update(2, (("describe", "A foo"), ("context", "When something")))
+        assert f.getvalue().startswith("[1/2] ")
+        assert f.getvalue().endswith(" - Describe: A foo")
+        progress.erase()
+        tw.line("- ✓ It: Does something")
+        assert f.getvalue().endswith("\r" + " " * 79 + "\r- ✓ It: Does something\n")
+
+
+@m.describe("The --it-only option")
+class TestOnly(object):
+    @m.it("Only displays the blocks containing a matching test")
+    def test_only_failed(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            pytestmark = pytest.mark.describe("A foo")
+
+            @pytest.mark.context("When passing")
+            def test_it_passes():
+                assert True
+
+            @pytest.mark.context("When failing")
+            def test_it_passes_too():
+                assert True
+
+            @pytest.mark.context("When failing")
+            def test_it_fails():
+                assert False
+        """
+        )
+        result = testdir.runpytest("--it-no-color", "--it-only=failed")
+        assert result.ret == 1
+        lines = [line.strip() for line in result.stdout.lines if line.strip()]
+        start = lines.index("- Describe: A foo...")
+        assert lines[start:][:5] == [
+            "- Describe: A foo...",
+            "- Context: When failing...",
+            "- F It: Fails",
+            "(1 passed)",
+            "(2 passed)",
+        ]
+        assert "- Context: When passing..." not in lines
+
+    @m.it("Counts the hidden tests in the right blocks")
+    @m.parametrize("args", [[], ["-n", "2"]])
+    def test_hidden_counts(self, testdir, args):
+        if args:
+            pytest.importorskip("xdist")
+        testdir.makepyfile(
+            test_a="""
+            import time
+            import pytest
+
+            @pytest.mark.describe("A foo")
+            def test_slow():
+                time.sleep(0.5)
+                assert False
+
+            @pytest.mark.describe("A bar")
+            def test_bar():
+                assert False
+
+            @pytest.mark.describe("A foo")
+            @pytest.mark.parametrize("param", range(3))
+            def test_foo(param):
+                assert param != 2
+        """,
+            test_b="""
+            import pytest
+
+            @pytest.mark.describe("A baz")
+            def test_baz():
+                assert False
+        """,
+        )
+        result = testdir.runpytest("--it-no-color", "--it-only=failed", *args)
+        lines = [line.strip() for line in result.stdout.lines if line.strip()]
+        start = lines.index("- Describe: A foo...")
+        lines = [line for line in lines[start:] if line[0] not in "*["]
+        assert lines[:7] == [
+            "- Describe: A foo...",
+            "- F test_slow",
+            "- Describe: A bar...",
+            "- F test_bar",
+            "- Describe: A foo...",
+            "- F test_foo[2] - [2]",
+            "(2 passed)",
+        ]
+        path_lines = [line for line in result.stdout.lines if line.startswith("* test_b")]
+        assert "passed" not in "".join(path_lines)
+
+    @m.it("Rejects unknown outcomes")
+    def test_invalid_outcome(self, testdir):
+        testdir.makepyfile("def test_a(): pass")
+        result = testdir.runpytest("--it", "--it-only=failed,bogus")
+        assert result.ret != 0
+        result.stderr.fnmatch_lines(["*expected a comma-separated list*"])
+
+
+@m.describe("Rerun tests")
+class TestReruns(object):
+    @m.it("Shows the final result of a rerun test and lists the flaky blocks")
+    def test_reruns(self, testdir):
+        pytest.importorskip("pytest_rerunfailures")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            RUNS = []
+
+            @pytest.mark.describe("Network")
+            @pytest.mark.it("Retries")
+            @pytest.mark.flaky(reruns=3)
+            def test_retries():
+                RUNS.append(1)
+                assert len(RUNS) == 3
+
+            @pytest.mark.describe("Network")
+            @pytest.mark.it("Gives up")
+            @pytest.mark.flaky(reruns=1)
+            def test_gives_up():
+                assert False
+
+            @pytest.mark.describe("Disk")
+            @pytest.mark.it("Reads")
+            def test_reads():
+                pass
+        """
+        )
+        result = testdir.runpytest("--it", "--it-no-color", "-p", "rerunfailures")
+        result.stdout.fnmatch_lines(
+            [
+                "- Describe: Network...",
+                "  - ✓ It: Retries (3 attempts)",
+                "  - F It: Gives up (2 attempts)",
+                "- Describe: Disk...",
+                "  - ✓ It: Reads",
+                "*flakiest spec blocks*",
+                "3 reruns in 2 tests (1 passed) Describe: Network",
+                "*1 failed, 2 passed, 3 rerun*",
+            ]
+        )
+        assert "Describe: Disk" not in result.stdout.str().split("flakiest")[-1]
+
+    @m.it("Prints the final result in collection order with pytest-xdist")
+    def test_reruns_xdist(self, testdir):
+        pytest.importorskip("pytest_rerunfailures")
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import os
+            import pytest
+
+            @pytest.mark.describe("Network")
+            @pytest.mark.it("Retries")
+            @pytest.mark.flaky(reruns=3)
+            def test_retries(runs_path):
+                with open(runs_path, "a") as f:
+                    f.write("x")
+                with open(runs_path) as f:
+                    assert len(f.read()) == 3
+
+            @pytest.mark.describe("Network")
+            @pytest.mark.it("Connects")
+            def test_connects():
+                pass
+
+            @pytest.mark.describe("Disk")
+            @pytest.mark.it("Reads")
+            def test_reads():
+                pass
+        """
+        )
+        testdir.makeconftest(
+            """
+            import pytest
+
+            @pytest.fixture
+            def runs_path():
+                return {!r}
+        """.format(
+                str(testdir.tmpdir.join("runs"))
+            )
+        )
+        result = testdir.runpytest(
+            "--it", "--it-no-color", "-p", "rerunfailures", "-n", "2"
+        )
+        result.stdout.fnmatch_lines(
+            [
+                "- Describe: Network...",
+                "  - ✓ It: Retries (3 attempts)",
+                "  - ✓ It: Connects",
+                "- Describe: Disk...",
+                "  - ✓ It: Reads",
+            ]
+        )
+        assert result.stdout.str().count("Describe: Network...") == 1
+
+    @m.it("Only records the final attempt in the jsonl file and the snapshot")
+    def test_reruns_records(self, testdir):
+        import json
+
+        pytest.importorskip("pytest_rerunfailures")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            RUNS = []
+
+            @pytest.mark.describe("Network")
+            @pytest.mark.it("Retries")
+            @pytest.mark.flaky(reruns=3)
+            def test_retries():
+                RUNS.append(1)
+                assert len(RUNS) == 3
+        """
+        )
+        result = testdir.runpytest(
+            "-p", "rerunfailures", "--it-jsonl", "spec.jsonl", "--it-snapshot", "snap"
+        )
+        assert result.ret == 0
+        with open(str(testdir.tmpdir.join("spec.jsonl"))) as f:
+            records = [json.loads(line) for line in f]
+        assert [(r["outcome"], r["attempts"]) for r in records] == [("passed", 3)]
+        with open(str(testdir.tmpdir.join("snap"))) as f:
+            entries = json.load(f)["entries"]
+        assert [entry[2] for entry in entries] == ["passed"]